@@ -0,0 +1,232 @@
+from pathlib import Path
+import time
+from typing import Iterator
+import numpy as np
+
+from facerec import models, similarity
+
+INDEX_FILE = 'faces_ivf.npz'
+
+
+def assign_to_centroids(vectors: np.ndarray, centroids: np.ndarray, block_size: int = 4096) -> np.ndarray:
+    assign = np.empty(vectors.shape[0], dtype=np.int32)
+    for start in range(0, vectors.shape[0], block_size):
+        block = vectors[start:start + block_size]
+        assign[start:start + block_size] = np.argmax(block @ centroids.T, axis=1)
+    return assign
+
+
+def kmeans(vectors: np.ndarray, n_clusters: int, iters: int = 20, seed: int = 0) -> np.ndarray:
+    """Spherical k-means: returns `n_clusters` unit-norm centroids."""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(vectors.shape[0], n_clusters, replace=False)].copy()
+    for _ in range(iters):
+        assign = assign_to_centroids(vectors, centroids)
+        order = np.argsort(assign, kind='stable')
+        counts = np.bincount(assign, minlength=n_clusters)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        nonempty = counts > 0
+        sums = np.add.reduceat(vectors[order], starts[nonempty], axis=0)
+        centroids[nonempty] = sums
+        # reseed empty clusters with random points
+        n_empty = int((~nonempty).sum())
+        if n_empty:
+            centroids[~nonempty] = vectors[rng.choice(vectors.shape[0], n_empty, replace=False)]
+        centroids /= np.linalg.norm(centroids, axis=1)[:, None]
+    return centroids
+
+
+class IVFIndex:
+    """Inverted-file index over normalized embeddings.
+
+    Vectors are bucketed by their closest k-means centroid; a query only
+    scans the `nprobe` buckets whose centroids are closest to it. Only
+    centroids, face ids and bucket assignments are saved: the vectors are
+    read from the embedding matrix the index is loaded with, `rows` giving
+    the row of every indexed face in it.
+    """
+
+    def __init__(self, centroids: np.ndarray, ids: np.ndarray, assign: np.ndarray,
+                 matrix: np.ndarray | None = None, rows: np.ndarray | None = None):
+        self.centroids = centroids
+        self.ids = ids
+        self.assign = assign
+        self.matrix = matrix
+        self.rows = rows
+        self._lists = None
+
+    @classmethod
+    def build(cls, vectors: np.ndarray, ids: list[int], nlist: int | None = None,
+              sample: int = 100_000, seed: int = 0) -> 'IVFIndex':
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        if nlist is None:
+            nlist = max(1, int(4 * np.sqrt(vectors.shape[0])))
+        nlist = min(nlist, vectors.shape[0])
+        rng = np.random.default_rng(seed)
+        train = vectors
+        if vectors.shape[0] > sample:
+            train = vectors[rng.choice(vectors.shape[0], sample, replace=False)]
+        centroids = kmeans(train, nlist, seed=seed)
+        assign = assign_to_centroids(vectors, centroids)
+        return cls(centroids, np.asarray(ids, dtype=np.int64), assign, vectors, np.arange(vectors.shape[0]))
+
+    @classmethod
+    def load(cls, data_root: Path, matrix: np.ndarray | None = None,
+             face_ids: list[int] | None = None) -> 'IVFIndex | None':
+        """Load the index; searching needs `matrix`, the embeddings of `face_ids`.
+
+        Indexed faces missing from `face_ids` are left out.
+        """
+        fname = data_root / INDEX_FILE
+        if not fname.exists():
+            return None
+        with np.load(fname) as data:
+            index = cls(data['centroids'], data['ids'], data['assign'])
+        if matrix is not None:
+            index.attach(matrix, face_ids)
+        return index
+
+    def attach(self, matrix: np.ndarray, face_ids: list[int]) -> None:
+        """Read vectors from `matrix`, whose rows embed `face_ids`."""
+        face_rows = {int(face_id): i for i, face_id in enumerate(face_ids)}
+        rows = np.array([face_rows.get(int(face_id), -1) for face_id in self.ids], dtype=np.int64)
+        found = rows >= 0
+        self.ids, self.assign, self.rows = self.ids[found], self.assign[found], rows[found]
+        self.matrix = matrix
+        self._lists = None
+
+    def save(self, data_root: Path) -> None:
+        fname = data_root / INDEX_FILE
+        tmp = fname.with_suffix('.tmp.npz')
+        np.savez(tmp, centroids=self.centroids, ids=self.ids, assign=self.assign)
+        tmp.replace(fname)
+
+    def __len__(self) -> int:
+        return self.ids.shape[0]
+
+    def add(self, vectors: np.ndarray, ids: list[int]) -> None:
+        """Insert new vectors into their closest buckets; centroids are left as they are.
+
+        Only usable on an index loaded without a matrix, as done to update the saved index.
+        """
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        self.ids = np.concatenate([self.ids, np.asarray(ids, dtype=np.int64)])
+        self.assign = np.concatenate([self.assign, assign_to_centroids(vectors, self.centroids)])
+        self.matrix = self.rows = None
+        self._lists = None
+
+    def vectors(self, positions: np.ndarray) -> np.ndarray:
+        return self.matrix[self.rows[positions]]
+
+    def lists(self) -> tuple[np.ndarray, np.ndarray]:
+        """Return (order, offsets): rows of bucket c are order[offsets[c]:offsets[c+1]]."""
+        if self._lists is None:
+            order = np.argsort(self.assign, kind='stable')
+            counts = np.bincount(self.assign, minlength=self.centroids.shape[0])
+            offsets = np.concatenate([[0], np.cumsum(counts)])
+            self._lists = order, offsets
+        return self._lists
+
+    def _rows_in(self, buckets: np.ndarray) -> np.ndarray:
+        order, offsets = self.lists()
+        return np.concatenate([order[:0]] + [order[offsets[c]:offsets[c + 1]] for c in buckets])
+
+    def _probe(self, vec: np.ndarray, nprobe: int) -> np.ndarray:
+        nprobe = min(nprobe, self.centroids.shape[0])
+        idx, _ = similarity.top_k(self.centroids, vec, nprobe)
+        return idx
+
+    def search(self, vec: np.ndarray, k: int, nprobe: int = 8) -> tuple[np.ndarray, np.ndarray]:
+        """Return ids and similarities of (approximately) the `k` closest vectors, best first."""
+        rows = self._rows_in(self._probe(vec.astype(np.float32), nprobe))
+        idx, sims = similarity.top_k(self.vectors(rows), vec.astype(np.float32), k)
+        return self.ids[rows[idx]], sims
+
+    def knn_blocks(self, threshold: float = 0.4, k: int | None = None, nprobe: int = 8,
+                   block_size: int = 256, rows: np.ndarray | None = None) -> Iterator[tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        """Approximate `similarity.knn_blocks` over the whole index, yielding id pairs.
+
+        All vectors of a bucket are queried together against the buckets
+        probed for that bucket's centroid. With `rows`, only the vectors at
+        these index positions are queried.
+        """
+        order, offsets = self.lists()
+        selected = None
+        if rows is not None:
+            selected = np.zeros(len(self.ids), dtype=bool)
+            selected[rows] = True
+        for c in range(self.centroids.shape[0]):
+            members = order[offsets[c]:offsets[c + 1]]
+            if selected is not None:
+                members = members[selected[members]]
+            if len(members) == 0:
+                continue
+            candidates = self._rows_in(self._probe(self.centroids[c], nprobe))
+            cand_vectors = self.vectors(candidates)
+            for start in range(0, len(members), block_size):
+                block = members[start:start + block_size]
+                sims = self.vectors(block) @ cand_vectors.T
+                sims[block[:, None] == candidates[None, :]] = -np.inf
+                r, cols, vals = similarity.select_neighbours(sims, threshold, k)
+                yield self.ids[block[r]], self.ids[candidates[cols]], vals
+
+
+def build_index(ctx: models.Context, nlist: int | None = None) -> IVFIndex:
+    faces, face_ids = ctx.get_embeddings()
+    print(f"Building index over {len(face_ids)} faces")
+    index = IVFIndex.build(faces, face_ids, nlist=nlist)
+    index.save(ctx.data_root)
+    return index
+
+
+def update_index(ctx: models.Context, face_ids: list[int]) -> None:
+    """Add freshly detected faces to the saved index, if there is one."""
+    index = IVFIndex.load(ctx.data_root)
+    if index is None or not face_ids:
+        return
+    faces, face_ids = ctx.get_embeddings(face_ids)
+    index.add(faces, face_ids)
+    index.save(ctx.data_root)
+    print(f"Added {len(face_ids)} faces to the index")
+
+
+def check_recall(index: IVFIndex, vectors: np.ndarray, ids: list[int], k: int = 20,
+                 nprobes: tuple[int, ...] = (1, 2, 4, 8, 16, 32, 64), sample: int = 500,
+                 seed: int = 0) -> dict[int, tuple[float, float]]:
+    """Compare index search against brute force on a sample of queries.
+
+    Returns {nprobe: (recall@k, milliseconds per query)}.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    ids = np.asarray(ids)
+    rng = np.random.default_rng(seed)
+    queries = rng.choice(vectors.shape[0], min(sample, vectors.shape[0]), replace=False)
+
+    def neighbours(found: np.ndarray, query_id: int) -> list[int]:
+        # the query itself is always found, it does not count
+        return [i for i in found.tolist() if i != query_id][:k]
+
+    truth = [set(neighbours(ids[similarity.top_k(vectors, vectors[q], k + 1)[0]], ids[q])) for q in queries]
+    total = max(sum(len(expected) for expected in truth), 1)
+    result = {}
+    for nprobe in nprobes:
+        if nprobe > index.centroids.shape[0]:
+            break
+        hits = 0
+        start = time.perf_counter()
+        for q, expected in zip(queries, truth):
+            found, _ = index.search(vectors[q], k + 1, nprobe)
+            hits += len(expected.intersection(neighbours(found, ids[q])))
+        elapsed = time.perf_counter() - start
+        result[nprobe] = (hits / total, 1000 * elapsed / len(queries))
+    return result
+
+
+def index_faces(data_root: Path, nlist: int | None = None, check: bool = True, k: int = 20) -> None:
+    ctx = models.Context(data_root)
+    index = build_index(ctx, nlist)
+    if check:
+        faces, face_ids = ctx.get_embeddings()
+        print(f"nprobe  recall@{k}  ms/query")
+        for nprobe, (recall, ms) in check_recall(index, faces, face_ids, k=k).items():
+            print(f"{nprobe:6d}  {recall:9.3f}  {ms:8.2f}")
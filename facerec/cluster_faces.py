@@ -1,40 +1,156 @@
 from pathlib import Path
 import numpy as np
 import tqdm
-import json
-import networkx as nx
 
-from facerec import models
+from facerec import models, similarity, ann_index, community, component_graph
+from facerec.graph_store import CSRGraph
+from facerec import graph_store
 
 
-def build_graph(ctx: models.Context) -> None:
-    if (ctx.data_root / "face_similarity.gexf").exists():
-        return nx.read_gexf(str(ctx.data_root / "face_similarity.gexf"))
+def load_graph(ctx: models.Context) -> CSRGraph | None:
+    return graph_store.load_graph(ctx.data_root)
+
+
+def save_graph(ctx: models.Context, graph: CSRGraph) -> None:
+    graph.save(ctx.data_root)
+
+
+def collect_edges(blocks, progress: tqdm.tqdm | None = None,
+                  step: int = 0) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Concatenate (ids, ids, sims) blocks into three edge arrays."""
+    ids1, ids2, sims = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.float32)]
+    for block1, block2, block_sims in blocks:
+        ids1.append(block1)
+        ids2.append(block2)
+        sims.append(block_sims.astype(np.float32))
+        if progress is not None:
+            progress.update(min(step, progress.total - progress.n) if step else 1)
+    if progress is not None:
+        progress.close()
+    return np.concatenate(ids1), np.concatenate(ids2), np.concatenate(sims)
+
+
+def build_graph(ctx: models.Context, threshold: float = 0.4, k: int | None = None,
+                block_size: int = 256, nprobe: int | None = None, weight_dtype: str = 'float32') -> CSRGraph:
+    if nprobe is not None:
+        # approximate graph: only compare faces within nearby index buckets
+        faces, face_ids = ctx.get_embeddings()
+        index = ann_index.IVFIndex.load(ctx.data_root, faces, face_ids)
+        if index is None:
+            index = ann_index.build_index(ctx)
+        blocks = index.knn_blocks(threshold=threshold, k=k, nprobe=nprobe, block_size=block_size)
+        edges = collect_edges(tqdm.tqdm(blocks, desc="Building graph"))
+    else:
+        faces, face_ids = ctx.get_embeddings()
+        faces = faces.astype(np.float32)
+        ids = np.array(face_ids, dtype=np.int64)
+        blocks = ((ids[rows], ids[cols], sims)
+                  for rows, cols, sims in similarity.knn_blocks(faces, threshold=threshold, k=k, block_size=block_size))
+        edges = collect_edges(blocks, tqdm.tqdm(total=faces.shape[0], desc="Building graph"), block_size)
+    graph = CSRGraph.from_edges(*edges, dtype=weight_dtype)
+    save_graph(ctx, graph)
+    return graph
+
+
+def add_new_faces(ctx: models.Context, graph: CSRGraph, threshold: float = 0.4, k: int | None = None,
+                  block_size: int = 256, nprobe: int | None = None,
+                  weight_dtype: str | None = None) -> tuple[CSRGraph, list[int]]:
+    """Add similarity edges for faces that are not in the graph yet.
+
+    Returns the updated graph and the faces that got edges. Faces without
+    any similar face never enter the graph, so they are compared again on
+    every run. With `nprobe`, new faces are compared through the ANN index
+    like in `build_graph`; with `weight_dtype`, the graph's weights are
+    converted to it.
+    """
     faces, face_ids = ctx.get_embeddings()
-    gr = nx.Graph()
-    for i in tqdm.trange(faces.shape[0], desc="Building graph"):
-        cosines = np.dot(faces, faces[i])
-        order = np.argsort(cosines)[::-1]
-        for j in order:
-            if cosines[j] < 0.4:
-                break
-            if i != j:
-                gr.add_edge(face_ids[i], face_ids[j], weight=cosines[j])
-    nx.write_gexf(gr, str(ctx.data_root / "face_similarity.gexf"))
-    return gr
+    ids = np.array(face_ids, dtype=np.int64)
+    new_rows = np.flatnonzero(graph.positions(ids) < 0)
+    if len(new_rows) == 0:
+        return graph, []
+    faces = faces.astype(np.float32)
+    if nprobe is not None:
+        index = ann_index.IVFIndex.load(ctx.data_root, faces, face_ids)
+        if index is None:
+            index = ann_index.build_index(ctx)
+        missing = np.setdiff1d(ids[new_rows], index.ids)
+        if len(missing):
+            ann_index.update_index(ctx, missing.tolist())
+            index = ann_index.IVFIndex.load(ctx.data_root, faces, face_ids)
+        positions = np.flatnonzero(np.isin(index.ids, ids[new_rows]))
+        blocks = index.knn_blocks(threshold=threshold, k=k, nprobe=nprobe, block_size=block_size, rows=positions)
+        edges = collect_edges(tqdm.tqdm(blocks, desc="Adding new faces"))
+    else:
+        blocks = ((ids[rows], ids[cols], sims)
+                  for rows, cols, sims in similarity.knn_blocks(faces, rows=new_rows, threshold=threshold, k=k, block_size=block_size))
+        edges = collect_edges(blocks, tqdm.tqdm(total=len(new_rows), desc="Adding new faces"), block_size)
+    graph = graph.add_edges(*edges, dtype=weight_dtype)
+    save_graph(ctx, graph)
+    new_ids = ids[new_rows]
+    return graph, new_ids[graph.positions(new_ids) >= 0].tolist()
+
+
+def assign_new_faces(graph: CSRGraph, components: list[list[int]], new_ids: list[int]) -> int:
+    """Attach new faces to existing communities in place, keeping community ids stable.
+
+    A face joins the community it has the largest total edge weight to;
+    faces linked only to other unassigned faces form new communities, one
+    per connected group. Returns the number of new communities.
+    """
+    face_to_component = {face_id: i for i, component in enumerate(components) for face_id in component}
+    unassigned = []
+    for face_id in sorted(new_ids):
+        if face_id in face_to_component:
+            continue
+        weights = {}
+        for neighbor, weight in zip(*graph.neighbors(face_id)):
+            comp_id = face_to_component.get(int(neighbor))
+            if comp_id is not None:
+                weights[comp_id] = weights.get(comp_id, 0) + float(weight)
+        if not weights:
+            unassigned.append(face_id)
+            continue
+        comp_id = max(weights, key=weights.get)
+        components[comp_id].append(face_id)
+        face_to_component[face_id] = comp_id
+    new_components = community.detect_communities(graph.subgraph(unassigned), 'components', max_size=len(unassigned))
+    new_components.sort()
+    components.extend(new_components)
+    return len(new_components)
 
 
-def compute_communities(ctx: models.Context, gr: nx.Graph) -> list[list[int]]:
-    communities = nx.community.louvain_communities(gr)
-    with open(ctx.data_root / "louvain_communities.json", "w") as f:
-        json.dump([list(c) for c in communities], f)
+def compute_communities(ctx: models.Context, graph: CSRGraph, algorithm: str = 'louvain',
+                        resolution: float = 1.0, seed: int = 0, max_size: int = 500) -> list[list[int]]:
+    communities = community.detect_communities(graph, algorithm=algorithm, resolution=resolution,
+                                               seed=seed, max_size=max_size)
+    ctx.save_components(communities)
+    return communities
 
 
 
-def cluster_faces(data_root: Path) -> None:
+def cluster_faces(data_root: Path, threshold: float = 0.4, k: int | None = None,
+                  block_size: int = 256, nprobe: int | None = None, rebuild: bool = False,
+                  weight_dtype: str = 'float32', algorithm: str = 'louvain', resolution: float = 1.0,
+                  seed: int = 0, max_size: int = 500) -> None:
     ctx = models.Context(data_root)
-    gr = build_graph(ctx)
-    communities = compute_communities(ctx, gr)
+    graph = None if rebuild else load_graph(ctx)
+    if graph is None:
+        graph = build_graph(ctx, threshold=threshold, k=k, block_size=block_size, nprobe=nprobe,
+                            weight_dtype=weight_dtype)
+        components = compute_communities(ctx, graph, algorithm=algorithm, resolution=resolution, seed=seed,
+                                         max_size=max_size)
+    else:
+        graph, new_ids = add_new_faces(ctx, graph, threshold=threshold, k=k, block_size=block_size, nprobe=nprobe,
+                                       weight_dtype=weight_dtype)
+        components = ctx.load_components()
+        if components:
+            num_new = assign_new_faces(graph, components, new_ids)
+            ctx.save_components(components)
+            print(f"Assigned {len(new_ids)} new faces, {num_new} new communities")
+        else:
+            components = compute_communities(ctx, graph, algorithm=algorithm, resolution=resolution, seed=seed,
+                                             max_size=max_size)
+    component_graph.build_component_graph(ctx, components)
     ctx.save()
 
 
@@ -0,0 +1,151 @@
+import numpy as np
+import networkx as nx
+
+from facerec.graph_store import CSRGraph
+
+ALGORITHMS = ('louvain', 'components', 'networkx')
+
+
+def _local_moving(indptr: np.ndarray, indices: np.ndarray, weights: np.ndarray, resolution: float,
+                  rng: np.random.Generator, tol: float = 1e-7) -> tuple[np.ndarray, bool]:
+    """One Louvain level: move nodes to the neighbouring community with the best modularity gain.
+
+    The graph is a symmetric CSR matrix whose diagonal holds the weight
+    inside already aggregated nodes. Returns node labels and whether any
+    node moved.
+    """
+    n = len(indptr) - 1
+    degree = np.bincount(np.repeat(np.arange(n), np.diff(indptr)), weights=weights, minlength=n)
+    two_m = degree.sum()
+    labels = np.arange(n)
+    tot = degree.copy()
+    # weight from the current node to each community, zeroed again after every node
+    k_in = np.zeros(n)
+    moved = False
+    if two_m == 0:
+        return labels, moved
+    while True:
+        improvement = 0.0
+        for i in rng.permutation(n):
+            start, end = indptr[i], indptr[i + 1]
+            nbrs, w = indices[start:end], weights[start:end]
+            not_self = nbrs != i
+            comms = labels[nbrs[not_self]]
+            own, k = labels[i], degree[i]
+            tot[own] -= k
+            np.add.at(k_in, comms, w[not_self])
+            best, best_gain = own, k_in[own] - resolution * tot[own] * k / two_m
+            if len(comms):
+                gains = k_in[comms] - resolution * tot[comms] * k / two_m
+                j = gains.argmax()
+                if gains[j] > best_gain:
+                    improvement += gains[j] - best_gain
+                    best, best_gain = comms[j], gains[j]
+                k_in[comms] = 0
+            tot[best] += k
+            labels[i] = best
+        if improvement * 2 / two_m <= tol:
+            break
+        moved = True
+    return labels, moved
+
+
+def _aggregate(indptr: np.ndarray, indices: np.ndarray, weights: np.ndarray,
+               labels: np.ndarray, n_comms: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """CSR matrix of summed edge weights between communities (diagonal: weight inside)."""
+    src = np.repeat(labels, np.diff(indptr))
+    key = src.astype(np.int64) * n_comms + labels[indices]
+    uniq, inv = np.unique(key, return_inverse=True)
+    rows = uniq // n_comms
+    new_indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=n_comms))])
+    return new_indptr, uniq % n_comms, np.bincount(inv, weights=weights)
+
+
+def louvain(graph: CSRGraph, resolution: float = 1.0, seed: int = 0) -> np.ndarray:
+    """Louvain community labels for the nodes of `graph`."""
+    rng = np.random.default_rng(seed)
+    indptr = np.asarray(graph.indptr)
+    indices = np.asarray(graph.indices).astype(np.int64)
+    weights = np.asarray(graph.weights, dtype=np.float64)
+    result = np.arange(len(graph.nodes))
+    while True:
+        labels, moved = _local_moving(indptr, indices, weights, resolution, rng)
+        _, labels = np.unique(labels, return_inverse=True)
+        result = labels[result]
+        n_comms = labels.max() + 1 if len(labels) else 0
+        if not moved or n_comms == len(indptr) - 1:
+            return result
+        indptr, indices, weights = _aggregate(indptr, indices, weights, labels, n_comms)
+
+
+def connected_components(graph: CSRGraph, min_weight: float | None = None) -> np.ndarray:
+    """Component labels, optionally ignoring edges lighter than `min_weight`."""
+    n = len(graph.nodes)
+    src = np.repeat(np.arange(n), np.diff(graph.indptr))
+    dst = np.asarray(graph.indices)
+    if min_weight is not None:
+        keep = np.asarray(graph.weights) >= min_weight
+        src, dst = src[keep], dst[keep]
+    # min-label propagation with pointer jumping
+    labels = np.arange(n)
+    while True:
+        prev = labels.copy()
+        np.minimum.at(labels, src, labels[dst])
+        while not np.array_equal(jumped := labels[labels], labels):
+            labels = jumped
+        if np.array_equal(labels, prev):
+            break
+    return np.unique(labels, return_inverse=True)[1]
+
+
+def threshold_components(graph: CSRGraph, max_size: int = 500, step: float = 0.05) -> list[np.ndarray]:
+    """Connected components; components above `max_size` are split again with a higher edge threshold."""
+    pending = [(graph, None)]
+    result = []
+    while pending:
+        sub, min_weight = pending.pop()
+        if min_weight is None:
+            min_weight = float(np.min(sub.weights)) if len(sub.weights) else 0.0
+        labels = connected_components(sub, min_weight)
+        for members in np.split(np.argsort(labels, kind='stable'), np.cumsum(np.bincount(labels))[:-1]):
+            face_ids = sub.nodes[members]
+            if len(face_ids) <= max_size or min_weight + step > 1:
+                result.append(face_ids)
+            else:
+                pending.append((sub.subgraph(face_ids), min_weight + step))
+    return result
+
+
+def group_labels(face_ids: np.ndarray, labels: np.ndarray) -> list[np.ndarray]:
+    """Split `face_ids` into one array per label."""
+    order = np.argsort(labels, kind='stable')
+    return np.split(np.asarray(face_ids)[order], np.cumsum(np.bincount(labels))[:-1])
+
+
+def sort_communities(groups) -> list[list[int]]:
+    """Communities as sorted face id lists, largest first."""
+    communities = [sorted(int(face_id) for face_id in group) for group in groups if len(group)]
+    return sorted(communities, key=lambda c: (-len(c), c[0]))
+
+
+def detect_communities(graph: CSRGraph, algorithm: str = 'louvain', resolution: float = 1.0,
+                       seed: int = 0, max_size: int = 500) -> list[list[int]]:
+    """Partition the faces of `graph` into communities, largest first.
+
+    Args:
+        algorithm: 'louvain' (on the CSR arrays), 'components' (connected
+            components, splitting those above `max_size` at increasing
+            thresholds) or 'networkx' (networkx Louvain).
+        resolution: Louvain resolution; higher values give smaller communities.
+        seed: random seed for the Louvain node order.
+        max_size: largest component kept whole by 'components'.
+    """
+    if algorithm == 'louvain':
+        groups = group_labels(graph.nodes, louvain(graph, resolution=resolution, seed=seed))
+    elif algorithm == 'components':
+        groups = threshold_components(graph, max_size=max_size)
+    elif algorithm == 'networkx':
+        groups = nx.community.louvain_communities(graph.to_networkx(), resolution=resolution, seed=seed)
+    else:
+        raise ValueError(f"Unknown community detection algorithm {algorithm!r}, expected one of {ALGORITHMS}")
+    return sort_communities(groups)
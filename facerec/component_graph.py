@@ -0,0 +1,171 @@
+from pathlib import Path
+import os
+import numpy as np
+import tqdm
+
+from facerec import models, similarity
+
+GRAPH_FILE = 'component_graph.npz'
+ARRAYS = ('sizes', 'centroids', 'medoids', 'centroid_nbrs', 'centroid_dists', 'linkage_nbrs', 'linkage_dists')
+
+
+class ComponentGraph:
+    """Summary of every component and its nearest components.
+
+    Per component: size, normalized centroid, medoid face id, and the `k`
+    nearest components by centroid distance and by min-linkage distance
+    (closest pair of faces). Distances are cosine distances; neighbour lists
+    are padded with -1 and distance inf. Min-linkage is only evaluated for
+    the `candidates` nearest components by centroid, on at most
+    `max_members` faces of each.
+    """
+
+    def __init__(self, sizes: np.ndarray, centroids: np.ndarray, medoids: np.ndarray,
+                 centroid_nbrs: np.ndarray, centroid_dists: np.ndarray,
+                 linkage_nbrs: np.ndarray, linkage_dists: np.ndarray):
+        self.sizes = sizes
+        self.centroids = centroids
+        self.medoids = medoids
+        self.centroid_nbrs = centroid_nbrs
+        self.centroid_dists = centroid_dists
+        self.linkage_nbrs = linkage_nbrs
+        self.linkage_dists = linkage_dists
+
+    @classmethod
+    def build(cls, matrix: np.ndarray, face_rows: dict[int, int], components: list[list[int]],
+              k: int = 10, candidates: int = 50, max_members: int = 500) -> 'ComponentGraph':
+        graph = cls.empty(matrix.shape[1], k)
+        graph.update(matrix, face_rows, components, range(len(components)), candidates, max_members)
+        return graph
+
+    @classmethod
+    def empty(cls, dim: int, k: int) -> 'ComponentGraph':
+        nbrs = np.full((0, k), -1, dtype=np.int32)
+        dists = np.full((0, k), np.inf, dtype=np.float32)
+        return cls(np.zeros(0, dtype=np.int64), np.zeros((0, dim), dtype=np.float32), np.zeros(0, dtype=np.int64),
+                   nbrs, dists, nbrs.copy(), dists.copy())
+
+    @classmethod
+    def load(cls, data_root: Path) -> 'ComponentGraph | None':
+        fname = data_root / GRAPH_FILE
+        if not fname.exists():
+            return None
+        with np.load(fname) as data:
+            return cls(*(data[name] for name in ARRAYS))
+
+    def save(self, data_root: Path) -> None:
+        fname = data_root / GRAPH_FILE
+        tmp = fname.with_suffix('.tmp.npz')
+        with open(tmp, 'wb') as f:
+            np.savez(f, **{name: getattr(self, name) for name in ARRAYS})
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, fname)
+
+    def __len__(self) -> int:
+        return len(self.sizes)
+
+    def copy(self) -> 'ComponentGraph':
+        return ComponentGraph(*(getattr(self, name).copy() for name in ARRAYS))
+
+    def neighbours(self, comp_id: int, by: str = 'centroid') -> list[tuple[int, float]]:
+        """(component, distance) pairs, nearest first; `by` is 'centroid' or 'linkage'."""
+        nbrs, dists = (self.centroid_nbrs, self.centroid_dists) if by == 'centroid' else (self.linkage_nbrs, self.linkage_dists)
+        return [(int(n), float(d)) for n, d in zip(nbrs[comp_id], dists[comp_id]) if n >= 0]
+
+    def _resize(self, n: int) -> None:
+        extra = n - len(self.sizes)
+        if extra <= 0:
+            return
+        k = self.centroid_nbrs.shape[1]
+        self.sizes = np.concatenate([self.sizes, np.zeros(extra, dtype=np.int64)])
+        self.centroids = np.concatenate([self.centroids, np.zeros((extra, self.centroids.shape[1]), dtype=np.float32)])
+        self.medoids = np.concatenate([self.medoids, np.full(extra, -1, dtype=np.int64)])
+        for name in ('centroid_nbrs', 'linkage_nbrs'):
+            setattr(self, name, np.concatenate([getattr(self, name), np.full((extra, k), -1, dtype=np.int32)]))
+        for name in ('centroid_dists', 'linkage_dists'):
+            setattr(self, name, np.concatenate([getattr(self, name), np.full((extra, k), np.inf, dtype=np.float32)]))
+
+    def update(self, matrix: np.ndarray, face_rows: dict[int, int], components: list[list[int]], comp_ids,
+               candidates: int = 50, max_members: int = 500) -> None:
+        """Recompute the given components (new ones included) and every neighbour list they may affect."""
+        self._resize(len(components))
+        comp_ids = np.unique(np.asarray(list(comp_ids), dtype=np.int64))
+        if len(comp_ids) == 0:
+            return
+        members = {}
+
+        def rows_of(comp_id: int) -> np.ndarray:
+            if comp_id not in members:
+                members[comp_id] = np.array([face_rows[f] for f in components[comp_id] if f in face_rows], dtype=np.int64)
+            return members[comp_id]
+
+        groups = [rows_of(i) for i in comp_ids]
+        self.sizes[comp_ids] = [len(rows) for rows in groups]
+        self.centroids[comp_ids] = similarity.centroids(matrix, groups)
+        for comp_id, rows in zip(comp_ids, groups):
+            # the medoid maximizes the summed similarity to all members, i.e. the similarity to their mean
+            ids = [f for f in components[comp_id] if f in face_rows]
+            self.medoids[comp_id] = ids[np.argmax(matrix[rows] @ self.centroids[comp_id])] if ids else -1
+
+        affected = np.zeros(len(self), dtype=bool)
+        affected[comp_ids] = True
+        if not affected.all():
+            affected |= np.isin(self.centroid_nbrs, comp_ids).any(axis=1)
+            affected |= np.isin(self.linkage_nbrs, comp_ids).any(axis=1)
+            # components that may get a changed component among their nearest
+            sims = (self.centroids @ self.centroids[comp_ids].T).max(axis=1)
+            affected |= sims > 1 - self.centroid_dists[:, -1]
+        self._update_neighbours(matrix, np.flatnonzero(affected), rows_of, candidates, max_members)
+
+    def _update_neighbours(self, matrix: np.ndarray, comp_ids: np.ndarray, rows_of, candidates: int,
+                           max_members: int, block_size: int = 256) -> None:
+        k = self.centroid_nbrs.shape[1]
+        valid = self.sizes > 0
+        rng = np.random.default_rng(0)
+
+        def sample(rows: np.ndarray) -> np.ndarray:
+            return rng.choice(rows, max_members, replace=False) if len(rows) > max_members else rows
+
+        progress = tqdm.tqdm(total=len(comp_ids), desc="Component neighbours", disable=len(comp_ids) < 1000)
+        for start in range(0, len(comp_ids), block_size):
+            block = comp_ids[start:start + block_size]
+            sims = self.centroids[block] @ self.centroids.T
+            sims[:, ~valid] = -np.inf
+            sims[np.arange(len(block)), block] = -np.inf
+            for comp_id, row in zip(block, sims):
+                m = min(max(k, candidates), len(row))
+                order = np.argpartition(-row, m - 1)[:m]
+                order = order[np.argsort(-row[order], kind='stable')]
+                order = order[np.isfinite(row[order])]
+                self.centroid_nbrs[comp_id] = -1
+                self.centroid_dists[comp_id] = np.inf
+                self.centroid_nbrs[comp_id, :min(k, len(order))] = order[:k]
+                self.centroid_dists[comp_id, :min(k, len(order))] = 1 - row[order[:k]]
+
+                self.linkage_nbrs[comp_id] = -1
+                self.linkage_dists[comp_id] = np.inf
+                own = sample(rows_of(comp_id))
+                cand = order[:candidates]
+                if len(own) == 0 or len(cand) == 0:
+                    continue
+                cand_rows = [sample(rows_of(c)) for c in cand]
+                offsets = np.concatenate([[0], np.cumsum([len(r) for r in cand_rows])[:-1]])
+                cand_vecs = matrix[np.concatenate(cand_rows)]
+                best = np.full(len(cand), -np.inf, dtype=np.float32)
+                for s in range(0, len(own), block_size):
+                    pair_sims = matrix[own[s:s + block_size]] @ cand_vecs.T
+                    best = np.maximum(best, np.maximum.reduceat(pair_sims.max(axis=0), offsets))
+                nearest = np.argsort(-best, kind='stable')[:k]
+                self.linkage_nbrs[comp_id, :len(nearest)] = cand[nearest]
+                self.linkage_dists[comp_id, :len(nearest)] = 1 - best[nearest]
+            progress.update(len(block))
+        progress.close()
+
+
+def build_component_graph(ctx: models.Context, components: list[list[int]], k: int = 10) -> ComponentGraph:
+    matrix, face_ids = ctx.get_embeddings()
+    face_rows = {face_id: i for i, face_id in enumerate(face_ids)}
+    graph = ComponentGraph.build(matrix, face_rows, components, k=k)
+    graph.save(ctx.data_root)
+    return graph
@@ -0,0 +1,210 @@
+import io
+import json
+import mmap
+import os
+import shutil
+import threading
+from pathlib import Path
+import numpy as np
+import tqdm
+from PIL import Image, features
+
+CROPS_DIR = 'face_crops'
+LEGACY_DIR = 'faces_extr'
+META_FILE = 'meta.json'
+INDEX_FILE = 'index.bin'
+FORMATS = {'jpeg': 'image/jpeg', 'webp': 'image/webp', 'avif': 'image/avif'}
+INDEX_DTYPE = np.dtype([('face_id', '<i8'), ('shard', '<i4'), ('length', '<i4'), ('offset', '<i8')])
+QUALITY = 90
+
+
+class CropStore:
+    """Face crops packed into append-only shard files.
+
+    Encoded crops are appended to `shard_NNNNN.bin` files of at most
+    `shard_bytes` each; `index.bin` holds a (face id, shard, length, offset)
+    record per crop, later records winning. Blobs are written first and
+    their index records on `flush()`, so an interrupted write only leaves
+    unreferenced bytes behind. Crops are read as slices of memory-mapped
+    shards. With `size`, crops are scaled down to fit a `size` square before
+    encoding.
+    """
+
+    def __init__(self, data_root: Path, format: str = 'jpeg', size: int | None = None,
+                 shard_bytes: int = 1 << 30):
+        self.root = data_root / CROPS_DIR
+        meta_file = self.root / META_FILE
+        if meta_file.exists():
+            with open(meta_file, 'r') as f:
+                meta = json.load(f)
+            format, size, shard_bytes = meta['format'], meta['size'], meta['shard_bytes']
+        if format not in FORMATS:
+            raise ValueError(f"Unsupported crop format {format}, expected one of {tuple(FORMATS)}")
+        if format != 'jpeg' and not features.check(format):
+            raise ValueError(f"Pillow was built without {format} support")
+        self.format = format
+        self.size = size
+        self.shard_bytes = shard_bytes
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.index = np.empty(0, dtype=INDEX_DTYPE)
+        self.rows: dict[int, int] = {}
+        self.index_bytes = 0
+        self.pending: list[tuple] = []
+        self.shard = max((int(p.stem.split('_')[1]) for p in self.root.glob('shard_*.bin')), default=0)
+        self.shard_file = None
+        self.maps: dict[int, mmap.mmap] = {}
+        self.refresh()
+
+    @classmethod
+    def open(cls, data_root: Path, new: bool = False) -> 'CropStore | None':
+        """The crop store of a data directory, or None while crops are still files in faces_extr.
+
+        With `new`, i.e. for databases without faces, a missing store is
+        created, meta.json included, so the database is in crop store mode
+        before its first face is saved.
+        """
+        if (data_root / CROPS_DIR / META_FILE).exists():
+            return cls(data_root)
+        if new:
+            store = cls(data_root)
+            store.save_meta()
+            return store
+        return None
+
+    def save_meta(self) -> None:
+        meta_file = self.root / META_FILE
+        if not meta_file.exists():
+            with open(meta_file, 'w') as f:
+                json.dump({'format': self.format, 'size': self.size, 'shard_bytes': self.shard_bytes}, f)
+
+    @property
+    def media_type(self) -> str:
+        return FORMATS[self.format]
+
+    def shard_path(self, shard: int) -> Path:
+        return self.root / f'shard_{shard:05d}.bin'
+
+    def refresh(self) -> None:
+        """Pick up index records appended since the last call, also by other processes."""
+        index_file = self.root / INDEX_FILE
+        if not index_file.exists():
+            return
+        with self.lock:
+            size = index_file.stat().st_size
+            size -= size % INDEX_DTYPE.itemsize
+            if size <= self.index_bytes:
+                return
+            with open(index_file, 'rb') as f:
+                f.seek(self.index_bytes)
+                new = np.frombuffer(f.read(size - self.index_bytes), dtype=INDEX_DTYPE)
+            # records whose blob did not make it to disk
+            shard_sizes = {s: self.shard_path(s).stat().st_size if self.shard_path(s).exists() else 0
+                           for s in np.unique(new['shard']).tolist()}
+            ok = new['offset'] + new['length'] <= np.array([shard_sizes[s] for s in new['shard'].tolist()], dtype=np.int64)
+            if not ok.all():
+                print(f"Ignoring {np.count_nonzero(~ok)} face crops missing from their shards")
+            start = len(self.index)
+            self.index = np.concatenate([self.index, new])
+            for i in np.flatnonzero(ok):
+                self.rows[int(new['face_id'][i])] = start + int(i)
+            self.index_bytes = size
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __contains__(self, face_id: int) -> bool:
+        return face_id in self.rows
+
+    def encode(self, face: np.ndarray) -> bytes:
+        img = Image.fromarray(face)
+        if self.size is not None:
+            img.thumbnail((self.size, self.size))
+        buf = io.BytesIO()
+        img.save(buf, format=self.format.upper(), quality=QUALITY)
+        return buf.getvalue()
+
+    def add(self, face_id: int, face: np.ndarray) -> None:
+        """Append the crop of a face, given as an RGB (or grayscale) array."""
+        self.add_encoded(face_id, self.encode(face))
+
+    def add_encoded(self, face_id: int, data: bytes) -> None:
+        with self.lock:
+            if self.shard_file is None:
+                self.shard_file = open(self.shard_path(self.shard), 'ab')
+            offset = self.shard_file.tell()
+            if offset > 0 and offset + len(data) > self.shard_bytes:
+                # pending index records point into this shard, so it has to be on disk before flush() writes them
+                self.shard_file.flush()
+                os.fsync(self.shard_file.fileno())
+                self.shard_file.close()
+                self.shard += 1
+                self.shard_file = open(self.shard_path(self.shard), 'ab')
+                offset = 0
+            self.shard_file.write(data)
+            self.pending.append((face_id, self.shard, len(data), offset))
+
+    def flush(self) -> None:
+        with self.lock:
+            if not self.pending:
+                return
+            self.save_meta()
+            # blobs first: index records without data behind them are ignored on load
+            self.shard_file.flush()
+            os.fsync(self.shard_file.fileno())
+            with open(self.root / INDEX_FILE, 'ab') as f:
+                f.write(np.array(self.pending, dtype=INDEX_DTYPE).tobytes())
+            self.pending = []
+        self.refresh()
+
+    def get(self, face_id: int) -> memoryview | None:
+        """Encoded crop of a face as a slice of its memory-mapped shard, None if there is none."""
+        if face_id not in self.rows:
+            self.refresh()
+            if face_id not in self.rows:
+                return None
+        record = self.index[self.rows[face_id]]
+        shard, start = int(record['shard']), int(record['offset'])
+        end = start + int(record['length'])
+        with self.lock:
+            mapped = self.maps.get(shard)
+            if mapped is None or len(mapped) < end:
+                # shards grow; readers still holding the old map keep it alive
+                with open(self.shard_path(shard), 'rb') as f:
+                    mapped = self.maps[shard] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(mapped)[start:end]
+
+
+def migrate_crops(data_root: Path, format: str = 'jpeg', size: int | None = None, remove: bool = False) -> None:
+    """Pack the crops in faces_extr into the crop store.
+
+    JPEG files are copied unchanged unless `size` is given; other formats
+    are re-encoded. An interrupted migration resumes where it stopped; the
+    format and size of an existing store are kept. With `remove`,
+    faces_extr is deleted afterwards.
+    """
+    legacy = data_root / LEGACY_DIR
+    store = CropStore(data_root, format=format, size=size)
+    store.save_meta()
+    format, size = store.format, store.size
+    files = []
+    if legacy.exists():
+        with os.scandir(legacy) as entries:
+            for entry in entries:
+                name, ext = os.path.splitext(entry.name)
+                if ext == '.jpg' and name.startswith('face_') and name[5:].isdigit() and int(name[5:]) not in store:
+                    files.append((int(name[5:]), entry.path))
+    files.sort()
+    for i, (face_id, path) in enumerate(tqdm.tqdm(files, desc="Packing face crops")):
+        if format == 'jpeg' and size is None:
+            with open(path, 'rb') as f:
+                store.add_encoded(face_id, f.read())
+        else:
+            with Image.open(path) as img:
+                store.add(face_id, np.asarray(img.convert('RGB')))
+        if i % 10000 == 0:
+            store.flush()
+    store.flush()
+    print(f"Packed {len(files)} face crops into {store.root}")
+    if remove and legacy.exists():
+        shutil.rmtree(legacy)
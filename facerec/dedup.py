@@ -0,0 +1,141 @@
+import os
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import numpy as np
+import tqdm
+from PIL import Image
+
+from facerec import models
+from facerec import detect_faces
+from facerec.community import connected_components, group_labels
+from facerec.graph_store import CSRGraph
+
+# images are decoded for hashing with at least this longest side; JPEG draft mode and RAW previews make it cheap
+HASH_DECODE_SIZE = 256
+HASH_SIZE = 8
+# set bits per byte value
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def dhash(image: np.ndarray, size: int = HASH_SIZE) -> int:
+    """Difference hash: signs of horizontal gradients of a size x size grayscale thumbnail."""
+    gray = Image.fromarray(image).convert('L').resize((size + 1, size), Image.Resampling.BILINEAR)
+    pixels = np.asarray(gray, dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def hash_image(image_obj: models.Image, cache_dir: Path | None = None) -> str | None:
+    image = detect_faces.load_image(image_obj, HASH_DECODE_SIZE, cache_dir)
+    if image is None:
+        return None
+    return f'{dhash(image):016x}'
+
+
+def hamming(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Bit distances between every hash of `a` and every hash of `b` (uint64 arrays)."""
+    xor = (a[:, None] ^ b[None, :]).view(np.uint8).reshape(len(a), len(b), 8)
+    return POPCOUNT[xor].sum(axis=-1, dtype=np.int32)
+
+
+def group_key(image_obj: models.Image) -> str:
+    """Only images with the same key are compared: the capture date, or the directory of undated images."""
+    if image_obj.capture_date is not None:
+        return image_obj.capture_date.date().isoformat()
+    return os.path.dirname(image_obj.best_filename)
+
+
+def near_duplicates(ids: np.ndarray, hashes: np.ndarray, max_distance: int,
+                    block_size: int = 1024) -> tuple[np.ndarray, np.ndarray]:
+    """Pairs of ids whose hashes differ in at most `max_distance` bits.
+
+    Distances are computed in `block_size` squares, so memory stays bounded for large buckets.
+    """
+    ids1, ids2 = [np.empty(0, dtype=ids.dtype)], [np.empty(0, dtype=ids.dtype)]
+    for start in range(0, len(ids), block_size):
+        for col_start in range(start, len(ids), block_size):
+            dist = hamming(hashes[start:start + block_size], hashes[col_start:col_start + block_size])
+            rows, cols = np.nonzero(dist <= max_distance)
+            rows, cols = rows + start, cols + col_start
+            keep = cols > rows
+            ids1.append(ids[rows[keep]])
+            ids2.append(ids[cols[keep]])
+    return np.concatenate(ids1), np.concatenate(ids2)
+
+
+def split_group(members: list[models.Image], max_distance: int) -> list[list[models.Image]]:
+    """Split a chained group into groups whose members are all within `max_distance` of their first image.
+
+    `members` come in order of preference for the representative. Images
+    that are not close to any representative end up alone.
+    """
+    hashes = np.array([int(img.phash, 16) for img in members], dtype=np.uint64)
+    remaining = np.arange(len(members))
+    groups = []
+    while len(remaining):
+        close = hamming(hashes[remaining[:1]], hashes[remaining])[0] <= max_distance
+        groups.append([members[i] for i in remaining[close]])
+        remaining = remaining[~close]
+    return groups
+
+
+def find_duplicates(data_root: Path, max_distance: int = 6, workers: int = 4) -> None:
+    """Hash all images and link groups of near-identical ones to a single representative.
+
+    Images taken on the same day (or, without a date, in the same directory)
+    whose hashes differ in at most `max_distance` of 64 bits are chained
+    into candidate groups. These are split again so that every member is
+    within `max_distance` of its representative, which is an image with its
+    own face detection if there is one; a slowly changing series of shots
+    does not collapse into one. Every other member gets `duplicate_of` set
+    to the representative, and `detect` skips linked images.
+    """
+    ctx = models.Context(data_root)
+    todo = [img for img in ctx.images.images.values() if img.phash is None]
+    with ThreadPoolExecutor(workers) as pool:
+        hashes = pool.map(hash_image, todo, [ctx.preview_cache_dir] * len(todo))
+        for img, phash in tqdm.tqdm(zip(todo, hashes), total=len(todo), desc="Hashing images"):
+            if phash is not None:
+                img.phash = phash
+                ctx.images.mark_dirty(img.id)
+
+    buckets = defaultdict(list)
+    for img in ctx.images.images.values():
+        if img.phash is not None:
+            buckets[group_key(img)].append(img)
+    ids1, ids2 = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)]
+    for bucket in buckets.values():
+        if len(bucket) > 1:
+            a, b = near_duplicates(np.array([img.id for img in bucket], dtype=np.int64),
+                                   np.array([int(img.phash, 16) for img in bucket], dtype=np.uint64), max_distance)
+            ids1.append(a)
+            ids2.append(b)
+    ids1, ids2 = np.concatenate(ids1), np.concatenate(ids2)
+    graph = CSRGraph.from_edges(ids1, ids2, np.ones(len(ids1), dtype=np.float32))
+    groups = group_labels(graph.nodes, connected_components(graph)) if len(graph.nodes) else []
+
+    duplicate_of = {}
+    linked_groups = 0
+    for group in groups:
+        members = [ctx.images.images[int(image_id)] for image_id in group]
+        # images that went through detection themselves come first, so their faces stay representative
+        members.sort(key=lambda img: (img.faces_detected_at is None or img.duplicate_of is not None, img.id))
+        for rep, *others in split_group(members, max_distance):
+            duplicate_of.update({img.id: rep.id for img in others})
+            linked_groups += len(others) > 0
+
+    linked = unlinked = 0
+    for img in ctx.images.images.values():
+        new = duplicate_of.get(img.id)
+        if new == img.duplicate_of:
+            continue
+        if new is None and not ctx.get_faces_in_image(img.id):
+            # a linked image without faces of its own has to be detected again
+            img.faces_detected_at = None
+            unlinked += 1
+        img.duplicate_of = new
+        linked += new is not None
+        ctx.images.mark_dirty(img.id)
+    ctx.save_images()
+    print(f"{len(duplicate_of)} duplicates in {linked_groups} groups; {linked} newly linked, {unlinked} unlinked")
@@ -1,35 +1,252 @@
 from pathlib import Path
 from datetime import datetime
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, replace
+from functools import lru_cache
+from typing import TYPE_CHECKING
+import queue
+import threading
 import numpy as np
 import tqdm
-from insightface.app import FaceAnalysis
 
 from facerec import models
 from facerec import images
+from facerec import ann_index
+from facerec.embeddings import DTYPES as EMBEDDING_DTYPES
 
-analyzer = FaceAnalysis(providers=['CPUExecutionProvider'])
-analyzer.prepare(ctx_id=0, det_size=(640, 640))
+if TYPE_CHECKING:
+    from insightface.app import FaceAnalysis
 
-def process_image(image_id: int, ctx: models.Context) -> int:
-    image_obj = ctx.images.images[image_id]
+
+# every model of the insightface packs, all loaded by FaceAnalysis by default
+ALL_MODULES = ('detection', 'landmark_2d_106', 'landmark_3d_68', 'genderage', 'recognition')
+
+
+@dataclass(frozen=True)
+class AnalyzerConfig:
+    # insightface tasks to load; facerec itself only needs 'detection' and 'recognition'
+    modules: tuple[str, ...] = ALL_MODULES
+    det_size: int = 640
+    threads: int | None = None
+    # images are decoded at reduced resolution with at least this longest side (None: full resolution)
+    decode_size: int | None = None
+    # aligned faces from many images are embedded in batches of this size (0: one face at a time)
+    rec_batch_size: int = 32
+    inter_threads: int | None = None
+    # onnxruntime graph optimization: 'disable', 'basic', 'extended' or 'all'
+    graph_opt_level: str = 'all'
+    # insightface model pack, and whether to use its int8 version made by `facerec quantize`
+    model_name: str = 'buffalo_l'
+    quantized: bool = False
+    # detect on the decoded image, then crop and embed faces from the full-resolution photo
+    full_res_faces: bool = False
+    # with full_res_faces: a face shorter than this (decoded image pixels) triggers a second
+    # detection pass on the full-resolution photo at twice det_size (None: no second pass)
+    small_face_size: int | None = None
+
+
+# insightface looks model packs up in <root>/models/<name>
+MODEL_ROOT = Path('~/.insightface').expanduser()
+QUANTIZED_SUFFIX = '_int8'
+
+
+def model_pack(config: AnalyzerConfig) -> str:
+    return config.model_name + QUANTIZED_SUFFIX if config.quantized else config.model_name
+
+
+GRAPH_OPT_LEVELS = {
+    'disable': 'ORT_DISABLE_ALL',
+    'basic': 'ORT_ENABLE_BASIC',
+    'extended': 'ORT_ENABLE_EXTENDED',
+    'all': 'ORT_ENABLE_ALL',
+}
+
+
+def create_analyzer(config: AnalyzerConfig) -> 'FaceAnalysis':
+    import onnxruntime
+    from insightface.app import FaceAnalysis
+
+    name = model_pack(config)
+    if config.quantized and not (MODEL_ROOT / 'models' / name).exists():
+        raise FileNotFoundError(f"No quantized {config.model_name} models, run `facerec quantize` first")
+    analyzer = FaceAnalysis(name=name, root=str(MODEL_ROOT), providers=['CPUExecutionProvider'],
+                            allowed_modules=list(config.modules))
+    if config.threads is not None or config.inter_threads is not None or config.graph_opt_level != 'all':
+        # FaceAnalysis does not forward session options, so rebuild the sessions
+        sess_options = onnxruntime.SessionOptions()
+        if config.threads is not None:
+            sess_options.intra_op_num_threads = config.threads
+        if config.inter_threads is not None:
+            sess_options.inter_op_num_threads = config.inter_threads
+        sess_options.graph_optimization_level = getattr(
+            onnxruntime.GraphOptimizationLevel, GRAPH_OPT_LEVELS[config.graph_opt_level])
+        for model in analyzer.models.values():
+            model.session = onnxruntime.InferenceSession(
+                model.model_file, sess_options=sess_options, providers=['CPUExecutionProvider'])
+    analyzer.prepare(ctx_id=0, det_size=(config.det_size, config.det_size))
+    return analyzer
+
+
+@lru_cache(maxsize=None)
+def get_analyzer(config: AnalyzerConfig = AnalyzerConfig()) -> 'FaceAnalysis':
+    """Shared analyzer, loaded on first use."""
+    return create_analyzer(config)
+
+
+def load_image(image_obj: models.Image, max_size: int | None = None, cache_dir: Path | None = None) -> np.ndarray | None:
     image_path = Path(image_obj.best_filename)
-    image: np.ndarray | None = images.get_image(image_path)
-    faces = []
-    if image is not None:
-        try:
-            if image.ndim == 3:
-                faces = analyzer.get(image[:,:,::-1])
-            if image.ndim == 2:
-                faces = analyzer.get(image)
-        except ValueError:
-            faces = []
-    else:
+    image = images.get_image(image_path, max_size, cache_dir)
+    if image is None:
         print(f"No image loaded for {image_path}")
+    return image
+
+
+def analyze(analyzer: 'FaceAnalysis', img: np.ndarray, batched: bool = False) -> list:
+    """FaceAnalysis.get, leaving out the recognition model when embeddings are computed in batches."""
+    if not batched:
+        return analyzer.get(img)
+    bboxes, kpss = analyzer.det_model.detect(img, max_num=0, metric='default')
+    return make_faces(analyzer, img, bboxes, kpss)
+
+
+def make_faces(analyzer: 'FaceAnalysis', img: np.ndarray, bboxes: np.ndarray, kpss: np.ndarray | None) -> list:
+    """Faces for detector output, with the attributes of all models but detection and recognition."""
+    from insightface.app.common import Face
+
+    faces = []
+    for i in range(bboxes.shape[0]):
+        face = Face(bbox=bboxes[i, 0:4], kps=kpss[i] if kpss is not None else None, det_score=bboxes[i, 4])
+        for taskname, model in analyzer.models.items():
+            if taskname not in ('detection', 'recognition'):
+                model.get(img, face)
+        faces.append(face)
+    return faces
+
+
+def detect(analyzer: 'FaceAnalysis', image: np.ndarray | None, batched: bool = False) -> list:
+    if image is None:
+        return []
+    try:
+        if image.ndim == 3:
+            return analyze(analyzer, image[:,:,::-1], batched)
+        if image.ndim == 2:
+            return analyze(analyzer, image, batched)
+    except ValueError:
+        pass
+    return []
+
+
+def to_bgr(image: np.ndarray) -> np.ndarray:
+    """Contiguous 3-channel BGR copy of an RGB or grayscale image, as insightface expects."""
+    if image.ndim == 2:
+        image = np.stack([image] * 3, axis=-1)
+    return np.ascontiguousarray(image[:, :, ::-1])
+
+
+def _overlaps(bbox: np.ndarray, others: list, min_iou: float = 0.5) -> bool:
+    for other in others:
+        w = min(bbox[2], other.bbox[2]) - max(bbox[0], other.bbox[0])
+        h = min(bbox[3], other.bbox[3]) - max(bbox[1], other.bbox[1])
+        if w <= 0 or h <= 0:
+            continue
+        union = (bbox[2] - bbox[0]) * (bbox[3] - bbox[1]) + (other.bbox[2] - other.bbox[0]) * (other.bbox[3] - other.bbox[1])
+        if w * h / (union - w * h) >= min_iou:
+            return True
+    return False
+
+
+def refine_faces(analyzer: 'FaceAnalysis', image_obj: models.Image, image: np.ndarray, faces: list,
+                 config: AnalyzerConfig, batched: bool = False,
+                 cache_dir: Path | None = None) -> tuple[np.ndarray, list]:
+    """Move faces found on the reduced `image` onto the full-resolution photo.
 
+    Returns the full-resolution image and the faces, whose boxes and
+    landmarks now refer to it. Photos without faces are not decoded again,
+    nor are JPEGs that `image` already shows at full resolution. For RAW
+    files the full-resolution photo is the largest embedded preview, as
+    everywhere else in facerec. If a face is shorter than `config.small_face_size`, the detector runs
+    once more on the full image at twice `det_size` and faces it finds in
+    addition are kept. Unless `batched`, embeddings are computed from the
+    full image.
+    """
+    if not faces:
+        return image, faces
+    full = None
+    if config.decode_size is not None:
+        size = images.get_full_size(Path(image_obj.best_filename))
+        # draft decoding only shrinks JPEGs at least twice the decode size
+        if size is None or max(size) > max(image.shape[:2]):
+            full = load_image(image_obj, None, cache_dir)
+    if full is None:
+        full = image
+    scale = np.array([full.shape[1] / image.shape[1], full.shape[0] / image.shape[0]])
+    for face in faces:
+        face.bbox = face.bbox * np.tile(scale, 2)
+        if face.kps is not None:
+            face.kps = face.kps * scale
+        if face.landmark_2d_106 is not None:
+            face.landmark_2d_106 = face.landmark_2d_106 * scale
+        if face.landmark_3d_68 is not None:
+            face.landmark_3d_68 = face.landmark_3d_68 * np.append(scale, scale.mean())
+    bgr = to_bgr(full)
+    small = config.small_face_size is not None and any(
+        min(face.bbox[2] - face.bbox[0], face.bbox[3] - face.bbox[1]) < config.small_face_size * scale.min()
+        for face in faces)
+    if small:
+        size = 2 * config.det_size
+        bboxes, kpss = analyzer.det_model.detect(bgr, input_size=(size, size), max_num=0, metric='default')
+        keep = [i for i in range(bboxes.shape[0]) if not _overlaps(bboxes[i], faces)]
+        faces = faces + make_faces(analyzer, bgr, bboxes[keep], kpss[keep] if kpss is not None else None)
+    if not batched and 'recognition' in analyzer.models:
+        for face in faces:
+            analyzer.models['recognition'].get(bgr, face)
+    return full, faces
+
+
+class RecognitionBatcher:
+    """Embeds aligned faces from many images with one recognition call per `batch_size` faces.
+
+    Embeddings reach ctx.embeddings when a batch is full and on `flush()`,
+    which has to run before the context is saved.
+    """
+
+    def __init__(self, ctx: models.Context, model, batch_size: int):
+        self.ctx = ctx
+        self.model = model
+        self.batch_size = batch_size
+        # models exported with a fixed batch dimension are fed in chunks of that size
+        model_batch = model.session.get_inputs()[0].shape[0]
+        self.chunk_size = model_batch if isinstance(model_batch, int) and model_batch > 0 else batch_size
+        self.pending: list[tuple[int, np.ndarray]] = []
+
+    def add(self, image: np.ndarray, faces: list[tuple[int, np.ndarray]]) -> None:
+        """Queue (face id, keypoints) pairs found in `image`."""
+        from insightface.utils import face_align
+
+        bgr = to_bgr(image)
+        for face_id, kps in faces:
+            self.pending.append((face_id, face_align.norm_crop(bgr, landmark=kps, image_size=self.model.input_size[0])))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        for start in range(0, len(self.pending), self.chunk_size):
+            chunk = self.pending[start:start + self.chunk_size]
+            embeddings = self.model.get_feat([crop for _, crop in chunk])
+            for (face_id, _), emb in zip(chunk, embeddings):
+                self.ctx.embeddings.add(face_id, emb)
+        self.pending = []
+
+
+def store_faces(ctx: models.Context, image_obj: models.Image, image: np.ndarray | None, faces: list,
+                writer: ThreadPoolExecutor | None = None, batcher: RecognitionBatcher | None = None,
+                crop_writes: list[Future] | None = None) -> int:
     image_obj.faces_detected_at = datetime.now()
+    ctx.images.mark_dirty(image_obj.id)
     if len(faces) == 0:
         return 0
 
+    to_embed = []
     for face in faces:
         x, y, w, h = face.bbox[0], face.bbox[1], face.bbox[2]-face.bbox[0], face.bbox[3]-face.bbox[1]
         emb: np.ndarray = face.embedding
@@ -40,35 +257,203 @@ def process_image(image_id: int, ctx: models.Context) -> int:
             img_width=image.shape[1],
             img_height=image.shape[0],
             x=int(x), y=int(y), w=int(w), h=int(h),
-            emb=emb.tolist(),
             face_data=str(face),
         )
         ctx.faces.add(face_obj)
+        if emb is None and batcher is not None:
+            to_embed.append((face_obj.id, face.kps))
+        else:
+            ctx.embeddings.add(face_obj.id, emb)
 
         face_img = images.cut_face(image, face_obj)
-        ctx.save_extracted_face(face_obj.id, face_img)
+        if writer is not None:
+            future = writer.submit(ctx.save_extracted_face, face_obj.id, face_img)
+            if crop_writes is not None:
+                crop_writes.append(future)
+        else:
+            ctx.save_extracted_face(face_obj.id, face_img)
+    if to_embed:
+        batcher.add(image, to_embed)
     return len(faces)
+
+
+def process_image(image_id: int, ctx: models.Context, config: AnalyzerConfig = AnalyzerConfig(),
+                  batcher: RecognitionBatcher | None = None) -> int:
+    image_obj = ctx.images.images[image_id]
+    image = load_image(image_obj, config.decode_size, ctx.preview_cache_dir)
+    faces = []
+    if image is not None:
+        analyzer = get_analyzer(config)
+        faces = detect(analyzer, image, batched=batcher is not None or config.full_res_faces)
+        if config.full_res_faces:
+            image, faces = refine_faces(analyzer, image_obj, image, faces, config, batched=batcher is not None,
+                                        cache_dir=ctx.preview_cache_dir)
+    return store_faces(ctx, image_obj, image, faces, batcher=batcher)
+
+
+def detect_pipelined(ctx: models.Context, image_ids: list[int], workers: int,
+                     config: AnalyzerConfig = AnalyzerConfig(), decoders: int | None = None):
+    """Yield (image_id, image, faces) in the order of `image_ids`.
+
+    Images are decoded by a thread pool into a bounded queue and picked up
+    by `workers` inference threads, each with its own FaceAnalysis.
+    """
+    decoders = decoders or workers
+    decoded = queue.Queue(maxsize=2 * workers)
+    results = queue.Queue(maxsize=2 * workers)
+    done = object()
+    # set when the consumer stops, early or not; all threads then wind down
+    stop = threading.Event()
+
+    def put(q: queue.Queue, item) -> bool:
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(q: queue.Queue):
+        while not stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return done
+
+    def feed():
+        pool = ThreadPoolExecutor(decoders)
+        try:
+            for seq, image_id in enumerate(image_ids):
+                future = pool.submit(load_image, ctx.images.images[image_id], config.decode_size, ctx.preview_cache_dir)
+                if not put(decoded, (seq, image_id, future)):
+                    break
+        except Exception as e:
+            put(results, e)
+        finally:
+            pool.shutdown(wait=False, cancel_futures=stop.is_set())
+            # workers always get their end marker, also when feeding failed
+            for _ in range(workers):
+                put(decoded, done)
+
+    batched = config.rec_batch_size > 0 and 'recognition' in config.modules
+    # with batched recognition the workers only detect, embeddings are computed by the consumer
+    worker_config = replace(config, modules=tuple(m for m in config.modules if m != 'recognition')) if batched else config
+
+    def infer():
+        try:
+            worker_analyzer = create_analyzer(worker_config)
+            while (item := get(decoded)) is not done:
+                seq, image_id, future = item
+                image = future.result()
+                faces = detect(worker_analyzer, image, batched or config.full_res_faces)
+                if config.full_res_faces and image is not None:
+                    image, faces = refine_faces(worker_analyzer, ctx.images.images[image_id], image, faces,
+                                                config, batched, ctx.preview_cache_dir)
+                put(results, (seq, image_id, image, faces))
+        except Exception as e:
+            put(results, e)
+        put(results, done)
+
+    pipeline = [threading.Thread(target=feed, daemon=True)]
+    pipeline += [threading.Thread(target=infer, daemon=True) for _ in range(workers)]
+    for t in pipeline:
+        t.start()
+
+    # hand results out in submission order so face ids match the sequential path
+    pending = {}
+    next_seq = 0
+    running = workers
+    try:
+        while running:
+            item = results.get()
+            if item is done:
+                running -= 1
+                continue
+            if isinstance(item, Exception):
+                raise item
+            seq, image_id, image, faces = item
+            pending[seq] = (image_id, image, faces)
+            while next_seq in pending:
+                yield pending.pop(next_seq)
+                next_seq += 1
+    finally:
+        # also reached when the consumer closes the generator early
+        stop.set()
+        for t in pipeline:
+            t.join()
+
+
 # %%
-def process_new_images(data_root: Path, force: bool = False) -> None:
+def process_new_images(data_root: Path, force: bool = False, workers: int = 0,
+                       config: AnalyzerConfig = AnalyzerConfig(), embedding_dtype: str | None = None) -> None:
     ctx = models.Context(data_root)
+    if embedding_dtype is not None:
+        if embedding_dtype not in EMBEDDING_DTYPES:
+            raise ValueError(f"Unsupported embedding dtype {embedding_dtype}, expected one of {EMBEDDING_DTYPES}")
+        if len(ctx.embeddings) == 0:
+            ctx.embeddings.dtype = embedding_dtype
+        elif ctx.embeddings.dtype != embedding_dtype:
+            print(f"Embedding store already uses {ctx.embeddings.dtype}, keeping it")
 
     image_ids = [img.id for img in ctx.images.images.values() if img.faces_detected_at is None or force]
+    # near-duplicates found by `dedup` share the faces of their representative
+    linked = set()
+    for image_id in image_ids:
+        image_obj = ctx.images.images[image_id]
+        if image_obj.duplicate_of is not None and image_obj.duplicate_of in ctx.images.images:
+            image_obj.faces_detected_at = datetime.now()
+            ctx.images.mark_dirty(image_id)
+            linked.add(image_id)
+    if linked:
+        print(f"Skipping {len(linked)} near-duplicate images")
+        image_ids = [i for i in image_ids if i not in linked]
+    first_new_face = ctx.faces.next_id
+
+    batcher = None
+    if config.rec_batch_size > 0 and 'recognition' in config.modules and image_ids:
+        batcher = RecognitionBatcher(ctx, get_analyzer(config).models['recognition'], config.rec_batch_size)
+
+    # crops queued on the writer; face records are only saved once their crops are written
+    crop_writes: list[Future] = []
+
+    def save():
+        for future in crop_writes:
+            future.result()
+        crop_writes.clear()
+        # faces are only saved together with their embeddings
+        if batcher is not None:
+            batcher.flush()
+        ctx.save()
 
     progress = tqdm.tqdm(total=len(image_ids), desc="Processing images")
     total_faces = 0
-    for i, image_id in enumerate(image_ids):
-        num_faces = process_image(image_id, ctx)
-        progress.update(1)
-        total_faces += num_faces
-        progress.set_postfix(faces=total_faces)
-        if i % 100 == 0:
-            ctx.save()
+    if workers > 0 and image_ids:
+        # crops are written in the background, records on this thread
+        with ThreadPoolExecutor(1) as writer:
+            results = detect_pipelined(ctx, image_ids, workers, config)
+            for i, (image_id, image, faces) in enumerate(results):
+                num_faces = store_faces(ctx, ctx.images.images[image_id], image, faces, writer, batcher, crop_writes)
+                progress.update(1)
+                total_faces += num_faces
+                progress.set_postfix(faces=total_faces)
+                if i % 100 == 0:
+                    save()
+    else:
+        for i, image_id in enumerate(image_ids):
+            num_faces = process_image(image_id, ctx, config, batcher)
+            progress.update(1)
+            total_faces += num_faces
+            progress.set_postfix(faces=total_faces)
+            if i % 100 == 0:
+                save()
     progress.close()
     print(f"Processed {total_faces} faces")
-    ctx.save()
+    save()
+    ann_index.update_index(ctx, [i for i in ctx.faces.faces if i >= first_new_face])
 
 
 # %%
 if __name__ == '__main__':
     process_new_images(Path('d'))
-
@@ -1,5 +1,9 @@
+import os
+import json
+from collections import defaultdict
 from pathlib import Path
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import exifread
 import tqdm
 
@@ -10,7 +14,8 @@ def get_capture_date(filepath: Path) -> datetime | None:
     """Extract capture date from image file metadata."""
     try:
         with open(filepath, 'rb') as img_file:
-            img = exifread.process_file(img_file)
+            # only the date tags are needed, stop before maker notes and thumbnails
+            img = exifread.process_file(img_file, details=False, stop_tag='DateTimeOriginal')
             date = None
             if 'EXIF DateTimeOriginal' in img:
                 date = datetime.strptime(img['EXIF DateTimeOriginal'].values, '%Y:%m:%d %H:%M:%S').date()
@@ -24,33 +29,156 @@ def get_capture_date(filepath: Path) -> datetime | None:
     return None
 
 
-def find_files(img_root: Path, data_root: Path) -> tuple[dict[Path, list[Path]], dict[str, list[Path]]]:
+MANIFEST_FILE = 'discover_manifest.json'
+
+
+def is_photo(path: str) -> bool:
+    ext = os.path.splitext(path)[1].lower()
+    return ext in models.RAW_EXTENSIONS or ext in models.JPG_EXTENSIONS
+
+
+def image_key(path: str) -> str:
+    return os.path.splitext(path)[0]
+
+
+def preferred_file(paths: list[str]) -> str:
+    """Pick the file an image is read from: JPEG over RAW (cheaper to decode, full resolution), then by name."""
+    return min(paths, key=lambda p: (os.path.splitext(p)[1].lower() not in models.JPG_EXTENSIONS, p))
+
+
+def load_manifest(data_root: Path) -> dict[str, dict]:
+    fname = data_root / MANIFEST_FILE
+    if not fname.exists():
+        return {}
+    with open(fname, 'r') as f:
+        return json.load(f)
+
+
+def save_manifest(data_root: Path, manifest: dict[str, dict]) -> None:
+    fname = data_root / MANIFEST_FILE
+    tmp = fname.with_suffix('.json.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp, fname)
+
+
+def scan_dir(path: str, cached: dict | None) -> dict:
+    """Manifest entry of one directory: its mtime, photo files with (size, mtime) and subdirectories.
+
+    The listing is reused from `cached` when the directory mtime did not change.
+    """
+    try:
+        mtime = os.stat(path).st_mtime_ns
+        if cached is not None and cached['mtime'] == mtime:
+            return cached
+        files, dirs = {}, []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(entry.name)
+                elif entry.is_file() and is_photo(entry.name):
+                    stat = entry.stat()
+                    files[entry.name] = [stat.st_size, stat.st_mtime_ns]
+    except OSError as e:
+        print(f"Error scanning {path}: {e}")
+        return {'mtime': None, 'files': {}, 'dirs': []}
+    return {'mtime': mtime, 'files': files, 'dirs': dirs}
+
+
+def walk_parallel(root: str, manifest: dict[str, dict], pool: ThreadPoolExecutor,
+                  progress: tqdm.tqdm) -> dict[str, dict]:
+    """Scan all directories below root concurrently, returning their new manifest entries."""
+    scanned = {}
+    pending = {pool.submit(scan_dir, root, manifest.get(root)): root}
+    while pending:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            path = pending.pop(future)
+            entry = future.result()
+            scanned[path] = entry
+            progress.update(len(entry['files']))
+            for d in entry['dirs']:
+                sub = os.path.join(path, d)
+                pending[pool.submit(scan_dir, sub, manifest.get(sub))] = sub
+    return scanned
+
+
+def under(path: str, root: str) -> bool:
+    return path == root or path.startswith(root + os.sep)
+
+
+def find_files(img_root: Path, data_root: Path, workers: int = 1, batch_size: int = 1000) -> None:
     ctx = models.Context(data_root)
-    root = Path(img_root)
-    new_images = 0
-    progress = tqdm.tqdm(desc='Discovering files')
-    for path, _, files in root.walk():
-        for file in files:
-            progress.update(1)
-            pf = Path(path / file).absolute()
-            ext = pf.suffix.lower()
-            idx = pf.with_suffix('')
-            if ext not in models.RAW_EXTENSIONS and ext not in models.JPG_EXTENSIONS:
+    root = str(Path(img_root).absolute())
+    manifest = load_manifest(data_root)
+    with ThreadPoolExecutor(workers) as pool:
+        progress = tqdm.tqdm(desc='Discovering files')
+        scanned = walk_parallel(root, manifest, pool, progress)
+        progress.close()
+
+        old_files = {os.path.join(d, name): tuple(sig) for d, entry in manifest.items() if under(d, root)
+                     for name, sig in entry['files'].items()}
+        files = {os.path.join(d, name): tuple(sig) for d, entry in scanned.items()
+                 for name, sig in entry['files'].items()}
+        siblings = defaultdict(list)
+        for f in files:
+            siblings[image_key(f)].append(f)
+        by_key = {img.key: img for img in ctx.images.images.values()}
+
+        # a file that vanished and reappeared elsewhere with the same name, size and mtime was moved
+        moved = 0
+        vanished = {(os.path.basename(f), *old_files[f]): f for f in old_files.keys() - files.keys()}
+        for f in sorted(files.keys() - old_files.keys()):
+            old_f = vanished.pop((os.path.basename(f), *files[f]), None)
+            img = by_key.get(image_key(old_f)) if old_f else None
+            if img is None or img.best_filename != old_f or image_key(f) in by_key:
+                continue
+            del by_key[img.key]
+            img.key = image_key(f)
+            img.best_filename = f
+            by_key[img.key] = img
+            ctx.images.mark_dirty(img.id)
+            moved += 1
+
+        missing = 0
+        for img in by_key.values():
+            if not under(img.best_filename, root):
                 continue
+            candidates = siblings.get(img.key)
+            if not candidates:
+                missing += 1
+                continue
+            # keep the file faces were detected on as long as it exists
+            if img.best_filename in files and img.faces_detected_at is not None:
+                continue
+            best = preferred_file(candidates)
+            if best != img.best_filename:
+                img.best_filename = best
+                ctx.images.mark_dirty(img.id)
 
-            if str(idx) not in ctx.images.images:
-                capture_date = get_capture_date(pf)
+        new_keys = sorted(k for k in siblings if k not in by_key)
+        progress = tqdm.tqdm(total=len(new_keys), desc='Reading capture dates')
+        for start in range(0, len(new_keys), batch_size):
+            batch = [(key, preferred_file(siblings[key])) for key in new_keys[start:start + batch_size]]
+            dates = pool.map(get_capture_date, [Path(f) for _, f in batch])
+            for (key, f), capture_date in zip(batch, dates):
                 img = models.Image(
                     id=0,  # id will be set by the database
-                    key=str(idx),
-                    best_filename=str(pf),
+                    key=key,
+                    best_filename=f,
                     capture_date=capture_date,
                     discovered_at=datetime.now()
                 )
                 ctx.images.add(img)
-                new_images += 1
+            ctx.save_images()
+            progress.update(len(batch))
+        progress.close()
     ctx.save()
-    print(f'Number of new images: {new_images}')
+
+    manifest = {d: entry for d, entry in manifest.items() if not under(d, root)}
+    manifest.update(scanned)
+    save_manifest(data_root, manifest)
+    print(f'Number of new images: {len(new_keys)}, moved: {moved}, missing: {missing}')
 
 if __name__ == '__main__':
     root = Path('/home/ushakov/photo/master/Archive-2012')
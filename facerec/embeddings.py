@@ -0,0 +1,136 @@
+import json
+import os
+from pathlib import Path
+import numpy as np
+
+EMB_FILE = 'embeddings.bin'
+IDS_FILE = 'embedding_ids.bin'
+META_FILE = 'embeddings.json'
+DTYPES = ('float32', 'float16', 'int8')
+
+
+def row_dtype(dtype: str, dim: int) -> np.dtype:
+    """On-disk layout of one row; int8 rows are followed by their float32 scale."""
+    if dtype == 'int8':
+        return np.dtype([('q', np.int8, (dim,)), ('scale', np.float32)])
+    return np.dtype((dtype, (dim,)))
+
+
+def encode(vecs: np.ndarray, dtype: str) -> np.ndarray:
+    """Rows of `vecs` in the storage layout of `dtype`."""
+    vecs = np.atleast_2d(vecs)
+    if dtype != 'int8':
+        return vecs.astype(dtype)
+    step = np.abs(vecs).max(axis=1) / 127
+    q = np.round(vecs / np.where(step > 0, step, 1)[:, None])
+    # scale to unit length rather than by the step, so dot products stay cosine similarities
+    norms = np.linalg.norm(q, axis=1)
+    rows = np.empty(len(vecs), dtype=row_dtype(dtype, vecs.shape[1]))
+    rows['q'] = q
+    rows['scale'] = 1 / np.where(norms > 0, norms, 1)
+    return rows
+
+
+def decode(rows: np.ndarray, dtype: str) -> np.ndarray:
+    """Inverse of `encode`; float rows are returned as they are."""
+    if dtype != 'int8':
+        return rows
+    return rows['q'] * rows['scale'][:, None]
+
+
+class EmbeddingStore:
+    """Append-only store of normalized face embeddings.
+
+    Rows live in a raw `embeddings.bin` matrix that is memory-mapped for
+    reading; `embedding_ids.bin` holds the face id of every row (int64) and
+    `embeddings.json` the element type and dimension. int8 rows are
+    quantized with one scale per row and dequantized when read.
+    """
+
+    def __init__(self, data_root: Path, dtype: str = 'float32', dim: int = 512):
+        self.data_root = data_root
+        self.dtype = dtype
+        self.dim = dim
+        meta_file = data_root / META_FILE
+        if meta_file.exists():
+            with open(meta_file, 'r') as f:
+                meta = json.load(f)
+            self.dtype = meta['dtype']
+            self.dim = meta['dim']
+        if self.dtype not in DTYPES:
+            raise ValueError(f"Unsupported embedding dtype {self.dtype}, expected one of {DTYPES}")
+        self.ids = self.read_ids()
+        self.rows = {int(face_id): row for row, face_id in enumerate(self.ids)}
+        self.pending_ids: list[int] = []
+        self.pending: list[np.ndarray] = []
+        self._matrix = None
+
+    @property
+    def row_bytes(self) -> int:
+        return row_dtype(self.dtype, self.dim).itemsize
+
+    def read_ids(self) -> np.ndarray:
+        ids_file = self.data_root / IDS_FILE
+        emb_file = self.data_root / EMB_FILE
+        if not ids_file.exists() or not emb_file.exists():
+            return np.empty(0, dtype=np.int64)
+        ids = np.fromfile(ids_file, dtype=np.int64)
+        # an interrupted append may leave the two files out of step
+        n = min(len(ids), emb_file.stat().st_size // self.row_bytes)
+        if n != len(ids) or n * self.row_bytes != emb_file.stat().st_size:
+            print(f"Truncating embedding store to {n} consistent rows")
+            with open(ids_file, 'r+b') as f:
+                f.truncate(n * 8)
+            with open(emb_file, 'r+b') as f:
+                f.truncate(n * self.row_bytes)
+            ids = ids[:n]
+        return ids
+
+    def __len__(self) -> int:
+        return len(self.rows) + len(self.pending_ids)
+
+    def add(self, face_id: int, emb: np.ndarray) -> None:
+        emb = np.asarray(emb, dtype=np.float64)
+        emb = emb / np.linalg.norm(emb)
+        self.pending_ids.append(face_id)
+        self.pending.append(emb)
+
+    def flush(self) -> None:
+        if not self.pending_ids:
+            return
+        meta_file = self.data_root / META_FILE
+        if not meta_file.exists():
+            with open(meta_file, 'w') as f:
+                json.dump({'dtype': self.dtype, 'dim': self.dim}, f)
+                f.flush()
+                os.fsync(f.fileno())
+        # rows first: ids without a row behind them are dropped on the next load; both are
+        # synced before the face records referring to them are written
+        with open(self.data_root / EMB_FILE, 'ab') as f:
+            f.write(encode(np.stack(self.pending), self.dtype).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        with open(self.data_root / IDS_FILE, 'ab') as f:
+            f.write(np.array(self.pending_ids, dtype=np.int64).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        start = len(self.ids)
+        self.ids = np.concatenate([self.ids, np.array(self.pending_ids, dtype=np.int64)])
+        for offset, face_id in enumerate(self.pending_ids):
+            self.rows[face_id] = start + offset
+        self.pending_ids = []
+        self.pending = []
+        self._matrix = None
+
+    def matrix(self) -> np.ndarray:
+        """Read-only memory map of all flushed rows (an in-memory float32 copy for int8)."""
+        if self._matrix is None:
+            if len(self.ids) == 0:
+                self._matrix = np.empty((0, self.dim), dtype=np.float32 if self.dtype == 'int8' else self.dtype)
+            elif self.dtype == 'int8':
+                self._matrix = decode(np.memmap(self.data_root / EMB_FILE, dtype=row_dtype(self.dtype, self.dim),
+                                                mode='r', shape=(len(self.ids),)), self.dtype)
+            else:
+                self._matrix = np.memmap(self.data_root / EMB_FILE, dtype=self.dtype, mode='r',
+                                         shape=(len(self.ids), self.dim))
+        return self._matrix
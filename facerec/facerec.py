@@ -5,23 +5,165 @@ class FaceRec:
     def __init__(self, data_dir: Path = Path('.')):
         self.data_dir = data_dir
 
-    def discover(self, src_dir: Path):
+    def discover(self, src_dir: Path, workers: int = 1):
+        """Find new photos below src_dir and read their capture dates.
+
+        Args:
+            workers: number of threads scanning directories and reading EXIF data.
+        """
         from facerec.discover_dir import find_files
-        find_files(src_dir, self.data_dir)
+        find_files(src_dir, self.data_dir, workers=workers)
+
+
+    def dedup(self, max_distance: int = 6, workers: int = 4):
+        """Link near-duplicate images (bursts, RAW+JPEG and edited copies) so that detect runs once per group.
+
+        Args:
+            max_distance: largest perceptual hash distance (of 64 bits) between an image and the
+                representative of its group.
+            workers: number of threads decoding previews for hashing.
+        """
+        from facerec.dedup import find_duplicates
+        find_duplicates(self.data_dir, max_distance=max_distance, workers=workers)
+
+    def detect(self, force: bool = False, workers: int = 0, threads: int | None = None,
+               det_size: int = 640, modules: tuple[str, ...] | None = None,
+               decode_size: int | None = None, rec_batch_size: int = 32, inter_threads: int | None = None,
+               graph_opt_level: str = 'all', quantized: bool = False, embedding_dtype: str | None = None,
+               full_res_faces: bool = False, small_face_size: int | None = None):
+        """Detect faces in discovered images and compute their embeddings.
+
+        Args:
+            force: re-process images that were already processed.
+            workers: number of parallel inference workers (0 processes images one by one).
+            threads: intra-op threads per inference worker (onnxruntime default if unset).
+            det_size: input size of the face detector.
+            modules: insightface models to load (all models of the pack if unset); 'detection'
+                and 'recognition' suffice for facerec and load faster.
+            decode_size: decode images at reduced resolution with at least this longest side
+                (full resolution if unset).
+            rec_batch_size: number of faces, gathered across images, embedded per recognition call
+                (0 embeds every face on its own).
+            inter_threads: inter-op threads per onnxruntime session (onnxruntime default if unset).
+            graph_opt_level: onnxruntime graph optimization level: disable, basic, extended or all.
+            quantized: use the int8 models made by `quantize`.
+            embedding_dtype: storage type of the embeddings (float32, float16 or int8), only
+                applied while the embedding store is empty.
+            full_res_faces: detect on the image decoded at decode_size, then crop and embed the
+                faces from the full-resolution photo (decoded only when faces were found).
+            small_face_size: with full_res_faces, a face shorter than this many pixels of the
+                decoded image triggers a second detection pass on the full-resolution photo.
+        """
+        from facerec.detect_faces import process_new_images, AnalyzerConfig, ALL_MODULES
+        config = AnalyzerConfig(modules=tuple(modules or ALL_MODULES), det_size=det_size, threads=threads,
+                                decode_size=decode_size, rec_batch_size=rec_batch_size,
+                                inter_threads=inter_threads, graph_opt_level=graph_opt_level,
+                                quantized=quantized, full_res_faces=full_res_faces,
+                                small_face_size=small_face_size)
+        process_new_images(self.data_dir, force, workers=workers, config=config, embedding_dtype=embedding_dtype)
+
+    def quantize(self, images: int = 50, per_channel: bool = True, compare: int = 200):
+        """Make int8 versions of the detection and recognition models, for `detect --quantized true`.
+
+        Args:
+            images: number of photos with faces used to calibrate activation ranges.
+            per_channel: quantize weights per output channel.
+            compare: number of photos on which the int8 models are compared against fp32
+                (0 skips the comparison; see `compare_models`).
+        """
+        from facerec.quantize import quantize_models, compare_models
+        quantize_models(self.data_dir, images=images, per_channel=per_channel)
+        if compare > 0:
+            compare_models(self.data_dir, images=compare)
+
+    def compare_models(self, images: int = 200, seed: int = 0):
+        """Compare int8 and fp32 models on the same photos and write quantization_report.json.
+
+        Reports matched detections, cosine similarity of the embeddings, how often
+        faces fall into the same cluster, and the same for float16 and int8 embedding storage.
 
+        Args:
+            images: number of random photos with faces to compare on.
+            seed: random seed for picking the photos.
+        """
+        from facerec.quantize import compare_models
+        compare_models(self.data_dir, images=images, seed=seed)
 
-    def detect(self, force: bool = False):
-        from facerec.detect_faces import process_new_images
-        process_new_images(self.data_dir, force)
+    def cluster(self, threshold: float = 0.4, k: int | None = None, block_size: int = 256,
+                nprobe: int | None = None, rebuild: bool = False, weight_dtype: str = 'float32',
+                algorithm: str = 'louvain', resolution: float = 1.0, seed: int = 0, max_size: int = 500):
+        """Build the face similarity graph and cluster it.
 
-    def cluster(self):
+        Once a graph and communities exist, only faces detected since are
+        added and attached to the existing communities.
+
+        Args:
+            threshold: minimal cosine similarity for an edge.
+            k: keep at most this many neighbours per face (no cap by default).
+            block_size: number of faces compared against all others at once.
+            nprobe: use the ANN index, probing this many buckets (exact search by default); also
+                applies when only new faces are added.
+            rebuild: rebuild the graph and communities from scratch.
+            weight_dtype: storage type of the edge weights, float32 or float16 (existing graphs
+                are converted).
+            algorithm: community detection, 'louvain', 'components' (connected components split
+                at increasing thresholds) or 'networkx' (the slower networkx Louvain).
+            resolution: Louvain resolution; higher values give smaller communities.
+            seed: random seed, so that repeated runs give the same communities.
+            max_size: largest community the 'components' algorithm keeps whole.
+        """
         from facerec.cluster_faces import cluster_faces
-        cluster_faces(self.data_dir)
+        cluster_faces(self.data_dir, threshold=threshold, k=k, block_size=block_size, nprobe=nprobe,
+                      rebuild=rebuild, weight_dtype=weight_dtype, algorithm=algorithm,
+                      resolution=resolution, seed=seed, max_size=max_size)
+
+    def index(self, nlist: int | None = None, check: bool = True):
+        """Build the approximate nearest-neighbour index over face embeddings.
+
+        Args:
+            nlist: number of index buckets (4*sqrt(number of faces) by default).
+            check: report recall against brute-force search for several nprobe values.
+        """
+        from facerec.ann_index import index_faces
+        index_faces(self.data_dir, nlist=nlist, check=check)
+
+    def migrate(self, dtype: str = 'float32'):
+        """Move face embeddings from faces.jsonl into the binary embedding store.
+
+        Args:
+            dtype: storage type of the embeddings, float32, float16 or int8 (one scale per row).
+        """
+        from facerec.models import migrate_embeddings
+        migrate_embeddings(self.data_dir, dtype)
+
+    def pack_crops(self, format: str = 'jpeg', size: int | None = None, remove: bool = False):
+        """Move the face crops from faces_extr into packed shard files (face_crops/).
+
+        Databases created from now on use the packed store from the start.
+
+        Args:
+            format: encoding of the crops: jpeg, webp or avif.
+            size: scale crops down to fit a square of this size (original size if unset).
+            remove: delete faces_extr once all crops are packed.
+        """
+        from facerec.crop_store import migrate_crops
+        migrate_crops(self.data_dir, format=format, size=size, remove=remove)
+
+    def sqlite(self):
+        """Copy the JSONL database into an SQLite database (facerec.db), which is used from then on."""
+        from facerec.sqlite_store import convert_to_sqlite
+        convert_to_sqlite(self.data_dir)
+
+    def serve(self, port: int = 8000, host: str = '127.0.0.1', prerender: bool = False):
+        """Start the web interface.
 
-    def serve(self, port: int = 8000, host: str = '127.0.0.1'):
+        Args:
+            prerender: render context images of all photos with faces in the background.
+        """
         import uvicorn
         import facerec.graphwalk.backend.main as main
         main.settings.subgraph_dir = self.data_dir
+        main.settings.prerender = prerender
         uvicorn.run(main.app, port=port, host=host)
 
 
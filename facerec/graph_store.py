@@ -0,0 +1,183 @@
+from pathlib import Path
+import os
+import shutil
+import numpy as np
+import networkx as nx
+
+GRAPH_DIR = 'face_similarity'
+# names the generation directory inside GRAPH_DIR that holds the current arrays
+CURRENT_FILE = 'current'
+ARRAYS = ('nodes', 'indptr', 'indices', 'weights')
+GEXF_FILE = 'face_similarity.gexf'
+
+
+class CSRGraph:
+    """Undirected weighted face graph in compressed sparse row form.
+
+    `nodes` holds the sorted face ids; the neighbours of node i are
+    `indices[indptr[i]:indptr[i+1]]` (int32 positions in `nodes`) with
+    `weights` at the same positions. Every edge is stored in both directions.
+    """
+
+    def __init__(self, nodes: np.ndarray, indptr: np.ndarray, indices: np.ndarray, weights: np.ndarray):
+        self.nodes = nodes
+        self.indptr = indptr
+        self.indices = indices
+        self.weights = weights
+
+    @classmethod
+    def from_edges(cls, ids1: np.ndarray, ids2: np.ndarray, weights: np.ndarray,
+                   nodes: np.ndarray | None = None, dtype: str = 'float32') -> 'CSRGraph':
+        """Build a graph from face id pairs; duplicate and reversed pairs are merged."""
+        ids1 = np.asarray(ids1, dtype=np.int64)
+        ids2 = np.asarray(ids2, dtype=np.int64)
+        weights = np.asarray(weights)
+        all_nodes = np.union1d(ids1, ids2)
+        if nodes is not None:
+            all_nodes = np.union1d(all_nodes, np.asarray(nodes, dtype=np.int64))
+        n = len(all_nodes)
+        src = np.searchsorted(all_nodes, np.concatenate([ids1, ids2]))
+        dst = np.searchsorted(all_nodes, np.concatenate([ids2, ids1]))
+        w = np.concatenate([weights, weights])
+        keep = src != dst
+        src, dst, w = src[keep], dst[keep], w[keep]
+        order = np.lexsort((dst, src))
+        src, dst, w = src[order], dst[order], w[order]
+        if len(src):
+            first = np.concatenate([[True], (src[1:] != src[:-1]) | (dst[1:] != dst[:-1])])
+            src, dst, w = src[first], dst[first], w[first]
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(src, minlength=n))]).astype(np.int64)
+        return cls(all_nodes, indptr, dst.astype(np.int32), w.astype(dtype))
+
+    @classmethod
+    def from_networkx(cls, gr: nx.Graph, dtype: str = 'float32') -> 'CSRGraph':
+        edges = list(gr.edges(data='weight', default=1.0))
+        ids1 = np.array([int(u) for u, _, _ in edges], dtype=np.int64)
+        ids2 = np.array([int(v) for _, v, _ in edges], dtype=np.int64)
+        weights = np.array([float(w) for _, _, w in edges])
+        nodes = np.array([int(n) for n in gr.nodes], dtype=np.int64)
+        return cls.from_edges(ids1, ids2, weights, nodes=nodes, dtype=dtype)
+
+    @classmethod
+    def load(cls, data_root: Path, mmap: bool = True) -> 'CSRGraph | None':
+        graph_dir = data_root / GRAPH_DIR
+        if (graph_dir / CURRENT_FILE).exists():
+            array_dir = graph_dir / (graph_dir / CURRENT_FILE).read_text().strip()
+        elif (graph_dir / 'indptr.npy').exists():
+            # arrays saved before generation directories
+            array_dir = graph_dir
+        else:
+            return None
+        mmap_mode = 'r' if mmap else None
+        arrays = [np.load(array_dir / f'{name}.npy', mmap_mode=mmap_mode) for name in ARRAYS]
+        return cls(*arrays)
+
+    def save(self, data_root: Path) -> None:
+        """Write the arrays to a new generation directory, then switch `current` to it atomically.
+
+        A crash leaves either the previous or the new arrays, never a mix.
+        Older generations are removed; graphs memory-mapped from them stay readable.
+        """
+        graph_dir = data_root / GRAPH_DIR
+        graph_dir.mkdir(exist_ok=True)
+        generations = [int(p.name[4:]) for p in graph_dir.glob('gen_*') if p.name[4:].isdigit()]
+        name = f'gen_{max(generations, default=0) + 1:06d}'
+        (graph_dir / name).mkdir()
+        for array in ARRAYS:
+            with open(graph_dir / name / f'{array}.npy', 'wb') as f:
+                np.save(f, getattr(self, array))
+                f.flush()
+                os.fsync(f.fileno())
+        tmp = graph_dir / f'{CURRENT_FILE}.tmp'
+        with open(tmp, 'w') as f:
+            f.write(name)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, graph_dir / CURRENT_FILE)
+        for old in graph_dir.iterdir():
+            if old.name.startswith('gen_') and old.name != name:
+                shutil.rmtree(old, ignore_errors=True)
+            elif old.suffix == '.npy':
+                old.unlink(missing_ok=True)
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    @property
+    def num_edges(self) -> int:
+        return len(self.indices) // 2
+
+    def positions(self, face_ids) -> np.ndarray:
+        """Positions of face ids in `nodes`, -1 for faces not in the graph."""
+        face_ids = np.asarray(face_ids, dtype=np.int64)
+        pos = np.searchsorted(self.nodes, face_ids)
+        pos[pos >= len(self.nodes)] = 0
+        found = len(self.nodes) > 0 and self.nodes[pos] == face_ids
+        return np.where(found, pos, -1)
+
+    def __contains__(self, face_id: int) -> bool:
+        return bool(self.positions([face_id])[0] >= 0)
+
+    def neighbors(self, face_id: int) -> tuple[np.ndarray, np.ndarray]:
+        """Face ids and weights of the neighbours of a face."""
+        i = self.positions([face_id])[0]
+        if i < 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=self.weights.dtype)
+        start, end = self.indptr[i], self.indptr[i + 1]
+        return self.nodes[self.indices[start:end]], np.asarray(self.weights[start:end])
+
+    def edges(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Each edge once, as (face ids, face ids, weights)."""
+        src = np.repeat(np.arange(len(self.nodes)), np.diff(self.indptr))
+        upper = src < self.indices
+        return self.nodes[src[upper]], self.nodes[self.indices[upper]], np.asarray(self.weights[upper])
+
+    def add_edges(self, ids1: np.ndarray, ids2: np.ndarray, weights: np.ndarray,
+                  dtype: str | None = None) -> 'CSRGraph':
+        """Graph with the given edges added; weights keep their type unless `dtype` is given."""
+        old1, old2, old_w = self.edges()
+        return CSRGraph.from_edges(np.concatenate([old1, ids1]), np.concatenate([old2, ids2]),
+                                   np.concatenate([old_w, weights]), nodes=self.nodes,
+                                   dtype=dtype or self.weights.dtype)
+
+    def subgraph(self, face_ids) -> 'CSRGraph':
+        """Graph induced by the given faces (those not in the graph are ignored)."""
+        pos = self.positions(face_ids)
+        pos = np.unique(pos[pos >= 0])
+        selected = np.zeros(len(self.nodes), dtype=bool)
+        selected[pos] = True
+        ids1, ids2, weights = [], [], []
+        for i in pos:
+            start, end = self.indptr[i], self.indptr[i + 1]
+            nbrs = np.asarray(self.indices[start:end])
+            keep = selected[nbrs] & (nbrs > i)
+            ids1.append(np.full(keep.sum(), self.nodes[i]))
+            ids2.append(self.nodes[nbrs[keep]])
+            weights.append(np.asarray(self.weights[start:end])[keep])
+        if not ids1:
+            return CSRGraph.from_edges([], [], np.empty(0, dtype=self.weights.dtype), nodes=[])
+        return CSRGraph.from_edges(np.concatenate(ids1), np.concatenate(ids2), np.concatenate(weights),
+                                   nodes=self.nodes[pos], dtype=self.weights.dtype)
+
+    def to_networkx(self) -> nx.Graph:
+        gr = nx.Graph()
+        gr.add_nodes_from(self.nodes.tolist())
+        ids1, ids2, weights = self.edges()
+        gr.add_weighted_edges_from(zip(ids1.tolist(), ids2.tolist(), weights.astype(np.float64).tolist()))
+        return gr
+
+
+def convert_gexf(data_root: Path, dtype: str = 'float32') -> CSRGraph:
+    print(f"Converting {data_root / GEXF_FILE} to {data_root / GRAPH_DIR}")
+    gr = nx.read_gexf(str(data_root / GEXF_FILE))
+    graph = CSRGraph.from_networkx(gr, dtype=dtype)
+    graph.save(data_root)
+    return graph
+
+
+def load_graph(data_root: Path) -> CSRGraph | None:
+    """Load the saved similarity graph, converting an old GEXF file on first use."""
+    graph = CSRGraph.load(data_root)
+    if graph is None and (data_root / GEXF_FILE).exists():
+        graph = convert_gexf(data_root)
+    return graph
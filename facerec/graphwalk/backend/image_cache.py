@@ -0,0 +1,125 @@
+import hashlib
+import math
+import os
+import threading
+from collections import OrderedDict
+from io import BytesIO
+from pathlib import Path
+from PIL import Image
+
+from facerec import images
+
+
+def image_etag(path: Path, max_size: int) -> str:
+    stat = path.stat()
+    key = f'{path.absolute()}:{stat.st_mtime_ns}:{stat.st_size}:{max_size}'
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def render_image(path: Path, max_size: int, preview_cache_dir: Path | None = None) -> bytes:
+    """Decode a photo at reduced resolution and encode it as JPEG with at most `max_size` longest side."""
+    image = images.get_image(path, max_size=max_size, cache_dir=preview_cache_dir)
+    if image is None:
+        raise ValueError(f"Cannot load image {path}")
+    img = Image.fromarray(image)
+    img.thumbnail((max_size, max_size))
+    buf = BytesIO()
+    img.convert('RGB').save(buf, format="JPEG", quality=90)
+    return buf.getvalue()
+
+
+def sprite_offsets(count: int, tile_size: int) -> list[tuple[int, int]]:
+    """Top-left corners of `count` square tiles in a roughly square grid."""
+    columns = max(1, math.ceil(math.sqrt(count)))
+    return [((i % columns) * tile_size, (i // columns) * tile_size) for i in range(count)]
+
+
+def render_sprite(sources: list, tile_size: int) -> tuple[bytes, bool]:
+    """Paste images scaled to fit `tile_size` squares into one JPEG, laid out by `sprite_offsets`.
+
+    Sources are paths or file objects; missing (None) or unreadable images leave their tile grey.
+    Returns the JPEG and whether every tile got its image.
+    """
+    offsets = sprite_offsets(len(sources), tile_size)
+    width = max((x for x, _ in offsets), default=0) + tile_size
+    height = max((y for _, y in offsets), default=0) + tile_size
+    sheet = Image.new('RGB', (width, height), (128, 128, 128))
+    complete = True
+    for source, (x, y) in zip(sources, offsets):
+        if source is None:
+            complete = False
+            continue
+        try:
+            with Image.open(source) as img:
+                img.draft('RGB', (tile_size, tile_size))
+                img = img.convert('RGB')
+        except OSError:
+            complete = False
+            continue
+        img.thumbnail((tile_size, tile_size))
+        sheet.paste(img, (x + (tile_size - img.width) // 2, y + (tile_size - img.height) // 2))
+    buf = BytesIO()
+    sheet.save(buf, format="JPEG", quality=90)
+    return buf.getvalue(), complete
+
+
+class RenderedImageCache:
+    """Rendered JPEGs by ETag: an LRU in memory bounded by `max_bytes`, backed by a directory on disk.
+
+    With `disk_bytes`, the disk directory is kept within that budget, evicting least recently used files.
+    """
+
+    def __init__(self, max_bytes: int, disk_dir: Path | None = None, disk_bytes: int | None = None):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_budget = images.CacheBudget(disk_dir, disk_bytes) if disk_dir is not None and disk_bytes else None
+        self.entries: OrderedDict[str, bytes] = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def _disk_path(self, etag: str) -> Path:
+        return self.disk_dir / etag[:2] / f'{etag}.jpg'
+
+    def get(self, etag: str) -> bytes | None:
+        with self.lock:
+            content = self.entries.get(etag)
+            if content is not None:
+                self.entries.move_to_end(etag)
+                return content
+        if self.disk_dir is not None:
+            fname = self._disk_path(etag)
+            try:
+                content = fname.read_bytes()
+            except FileNotFoundError:
+                return None
+            images.CacheBudget.touch(fname)
+            self._remember(etag, content)
+            return content
+        return None
+
+    def contains(self, etag: str) -> bool:
+        with self.lock:
+            if etag in self.entries:
+                return True
+        return self.disk_dir is not None and self._disk_path(etag).exists()
+
+    def put(self, etag: str, content: bytes) -> None:
+        if self.disk_dir is not None:
+            fname = self._disk_path(etag)
+            fname.parent.mkdir(parents=True, exist_ok=True)
+            tmp = fname.with_suffix(f'.{threading.get_ident()}.tmp')
+            tmp.write_bytes(content)
+            os.replace(tmp, fname)
+            if self.disk_budget is not None:
+                self.disk_budget.added(len(content))
+        self._remember(etag, content)
+
+    def _remember(self, etag: str, content: bytes) -> None:
+        with self.lock:
+            if etag in self.entries:
+                return
+            self.entries[etag] = content
+            self.size += len(content)
+            while self.size > self.max_bytes and self.entries:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
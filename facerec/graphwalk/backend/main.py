@@ -1,7 +1,12 @@
 import math
-import json
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import urlencode
 from dataclasses import dataclass
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import FileResponse, Response
 from fastapi.staticfiles import StaticFiles
@@ -10,22 +15,33 @@ import os
 from pathlib import Path
 from typing import List, Dict, Optional, Tuple, Union
 import random
-import networkx as nx
 from pydantic import BaseModel
-from heapq import nsmallest
-from itertools import product
 from rapidfuzz import process
 from importlib.resources import files
 from io import BytesIO
-from PIL import Image
 
-from facerec import models, images
+from facerec import models, ann_index, similarity, subdivide
+from facerec.component_graph import ComponentGraph
+from facerec.graphwalk.backend import image_cache
+from facerec.graphwalk.backend.state_store import StateStore
+from facerec.graphwalk.backend.person_index import PersonIndex
 
 
 @dataclass
 class Settings:
     static_root = files('facerec')
     subgraph_dir: Path = Path(".")
+    # similar-faces search: candidates fetched from the ANN index and buckets probed
+    similar_candidates: int = 2000
+    nprobe: int = 16
+    # rendered context images: memory and disk budgets, render threads, pre-render on startup
+    image_cache_bytes: int = 256 * 1024 * 1024
+    rendered_cache_bytes: int = 2 * 1024 ** 3
+    render_workers: int = 4
+    prerender: bool = False
+    # subdivision proposals: worker threads and number of cached proposals
+    subdivision_workers: int = 2
+    subdivision_cache_size: int = 256
 
 settings = Settings()
 
@@ -47,50 +63,84 @@ app.add_middleware(
 FACES_DIR = None
 faces = None
 face_ids = None
+# face id -> row of `faces`, shared by all endpoints
+face_rows: dict[int, int] = None
 face_ctx: models.Context = None
+face_index: ann_index.IVFIndex | None = None
+
+IMAGE_MAX_SIZE = 1024
+# face crops never change once written, so browsers may keep them
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+MAX_BATCH_FACES = 400
+rendered_images: image_cache.RenderedImageCache = None
+render_pool: ThreadPoolExecutor = None
 
 components = None
 face_to_component = None
-graph = None
-subgraph = None
-
-def load_graph():
-    global graph
-    if graph is None:
-        graph = nx.read_gexf(str(settings.subgraph_dir / "face_similarity.gexf"))
-        # Convert node IDs to integers
-        graph = nx.relabel_nodes(graph, lambda x: int(x))
+component_graph: ComponentGraph | None = None
+# serializes component graph updates, which run off the event loop on a copy that is swapped in
+graph_lock = threading.Lock()
+subdivision_pool: ThreadPoolExecutor = None
+state: StateStore = None
+person_index: PersonIndex = None
+# (comp_id, method, k) -> proposed sub-communities, least recently used first
+subdivisions: OrderedDict[tuple, list[list[int]]] = OrderedDict()
+# image id -> all images of its near-duplicate group (see facerec.dedup), for grouped images only
+duplicate_groups: dict[int, list[int]] = {}
 
 
 @app.on_event("startup")
 async def load_data():
-    global FACES_DIR, face_ctx, faces, face_ids, components, face_to_component, PEOPLE_FILE, COMPONENT_PEOPLE_FILE, people, component_people
+    global FACES_DIR, face_ctx, faces, face_ids, face_rows, face_index, components, face_to_component, people, component_people
+    global rendered_images, render_pool, component_graph, subdivision_pool, state, person_index, duplicate_groups
     FACES_DIR = settings.subgraph_dir / "faces_extr"
     face_ctx = models.Context(settings.subgraph_dir)
     faces, face_ids = face_ctx.get_embeddings()
-    components = []
-    face_to_component = {}
-
-    with open(settings.subgraph_dir / f"louvain_communities.json", 'r') as f:
-        data = json.load(f)
-        # Convert all face IDs to integers when loading
-        components = [[int(face_id) for face_id in component] for component in data]
-    face_to_component = {int(face_id): i for i, component in enumerate(components) for face_id in component}
-
-    PEOPLE_FILE = settings.subgraph_dir / "people.json"
-    COMPONENT_PEOPLE_FILE = settings.subgraph_dir / "component_people.json"
-    people = {}
-    component_people = {}
-    if PEOPLE_FILE.exists():
-        with open(PEOPLE_FILE, 'r') as f:
-            data = json.load(f)
-            for k, v in data.items():
-                people[int(k)] = Person(id=int(k), name=v)
-    if COMPONENT_PEOPLE_FILE.exists():
-        with open(COMPONENT_PEOPLE_FILE, 'r') as f:
-            data = json.load(f)
-            for k, v in data.items():
-                component_people[int(k)] = int(v)
+    face_rows = {face_id: i for i, face_id in enumerate(face_ids)}
+    face_index = ann_index.IVFIndex.load(settings.subgraph_dir, faces, face_ids)
+    if face_index is not None:
+        print(f"Loaded ANN index with {len(face_index)} faces")
+    components = face_ctx.load_components()
+    face_to_component = {face_id: i for i, component in enumerate(components) for face_id in component}
+    component_graph = ComponentGraph.load(settings.subgraph_dir)
+    if component_graph is None or len(component_graph) != len(components):
+        component_graph = ComponentGraph.build(faces, face_rows, components)
+        component_graph.save(settings.subgraph_dir)
+
+    # read once: after `dedup` the server has to be restarted to show the new groups
+    groups = {}
+    for image_id, duplicate_of in sorted(face_ctx.images.duplicate_links().items()):
+        groups.setdefault(duplicate_of, [duplicate_of]).append(image_id)
+    duplicate_groups = {image_id: group for group in groups.values() for image_id in group}
+
+    people = {k: Person(id=k, name=v) for k, v in face_ctx.load_people().items()}
+    component_people = face_ctx.load_component_people()
+    person_index = PersonIndex(components, component_people, face_date)
+    # mutations of these are saved by a single writer thread
+    state = StateStore({
+        'components': (lambda: [list(c) for c in components], face_ctx.save_components),
+        'people': (lambda: {k: v.name for k, v in people.items()}, face_ctx.save_people),
+        'component_people': (lambda: dict(component_people), face_ctx.save_component_people),
+        'component_graph': (lambda: component_graph.copy(), lambda g: g.save(settings.subgraph_dir)),
+    })
+
+    rendered_images = image_cache.RenderedImageCache(settings.image_cache_bytes, settings.subgraph_dir / "rendered_cache",
+                                                     settings.rendered_cache_bytes)
+    render_pool = ThreadPoolExecutor(settings.render_workers)
+    subdivision_pool = ThreadPoolExecutor(settings.subdivision_workers)
+    if settings.prerender:
+        threading.Thread(target=prerender_images, daemon=True).start()
+
+
+def face_date(face_id: int) -> str | None:
+    """Capture date of the image of a face as YYYY-MM-DD"""
+    image_date = face_ctx.images.images[face_ctx.faces.faces[face_id].image_id].capture_date
+    return image_date.strftime("%Y-%m-%d") if image_date is not None else None
+
+
+@app.on_event("shutdown")
+async def flush_state():
+    await commit()
 
 class FaceWithSimilarity(BaseModel):
     id: int
@@ -104,6 +154,9 @@ class FaceWithContext(FaceWithSimilarity):
     image_path: str
     image_date: str | None
     other_faces: list[FaceWithSimilarity]
+    # near-duplicates of the image, and the faces on them at the same place as this one
+    duplicate_images: list[int] = []
+    duplicate_faces: list[int] = []
 
 
 class Person(BaseModel):
@@ -116,15 +169,9 @@ class PersonCreate(BaseModel):
 class ComponentPerson(BaseModel):
     person_id: int
 
-def save_people():
-    """Persist people database to disk"""
-    with open(PEOPLE_FILE, 'w') as f:
-        json.dump({k: v.name for k, v in people.items()}, f)
-
-def save_component_people():
-    """Persist component-person assignments to disk"""
-    with open(COMPONENT_PEOPLE_FILE, 'w') as f:
-        json.dump({k: v for k, v in component_people.items()}, f)
+async def commit(*parts: str):
+    """Wait until the changed parts of the state are persisted to disk"""
+    await asyncio.wrap_future(state.commit(*parts))
 
 
 @app.get("/random-faces")
@@ -134,6 +181,56 @@ async def get_random_faces(count: int = 20) -> List[FaceWithSimilarity]:
     return [create_face_with_similarity(face_ids[i]) for i in indices]
 
 
+class FaceBatch(BaseModel):
+    faces: List[FaceWithSimilarity]
+    # the crops of all faces in one image, each in a tile_size square at its offset
+    sprite_url: str
+    tile_size: int
+    offsets: Dict[int, Tuple[int, int]]
+
+
+def check_batch(ids: List[int], tile_size: int):
+    if len(ids) > MAX_BATCH_FACES:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_FACES} faces per request")
+    if not 16 <= tile_size <= 512:
+        raise HTTPException(status_code=400, detail="tile_size must be between 16 and 512")
+
+
+@app.get("/faces")
+async def get_faces(ids: List[int] = Query(...), tile_size: int = 112) -> FaceBatch:
+    """Get component and person information for many faces, with their places in the sprite
+
+    Repeated ids are listed, and get a tile, once.
+    """
+    ids = list(dict.fromkeys(ids))
+    check_batch(ids, tile_size)
+    offsets = image_cache.sprite_offsets(len(ids), tile_size)
+    query = urlencode([("ids", face_id) for face_id in ids] + [("tile_size", tile_size)])
+    return FaceBatch(
+        faces=[create_face_with_similarity(face_id) for face_id in ids],
+        sprite_url=f"/faces/sprite?{query}",
+        tile_size=tile_size,
+        offsets=dict(zip(ids, offsets)),
+    )
+
+
+@app.get("/faces/sprite")
+async def get_face_sprite(ids: List[int] = Query(...), tile_size: int = 112):
+    """Serve the crops of many faces as one image, laid out as described by /faces"""
+    ids = list(dict.fromkeys(ids))
+    check_batch(ids, tile_size)
+    sources = [FACES_DIR / f"face_{face_id}.jpg" for face_id in ids]
+    if face_ctx.crops is not None:
+        # crops not packed yet are still read from faces_extr
+        sources = [BytesIO(crop) if (crop := face_ctx.crops.get(face_id)) is not None else path
+                   for face_id, path in zip(ids, sources)]
+    loop = asyncio.get_running_loop()
+    content, complete = await loop.run_in_executor(render_pool, image_cache.render_sprite, sources, tile_size)
+    # grey tiles may get their crop later
+    cache_control = IMMUTABLE_CACHE if complete else "no-cache"
+    return Response(content=content, media_type="image/jpeg", headers={"Cache-Control": cache_control})
+
+
 class SimilarFacesResponse(BaseModel):
     query_face: FaceWithSimilarity
     similar_faces: List[FaceWithSimilarity]
@@ -154,24 +251,47 @@ def create_face_with_similarity(face_id: int, similarity: float = 0.0) -> FaceWi
     )
 
 
-def create_face_with_context(face_id: int) -> FaceWithContext:
+def same_place(a: models.Face, b: models.Face, min_iou: float = 0.5) -> bool:
+    """Whether two faces on near-duplicate images cover the same part of the picture"""
+    ax, ay, aw, ah = a.x / a.img_width, a.y / a.img_height, a.w / a.img_width, a.h / a.img_height
+    bx, by, bw, bh = b.x / b.img_width, b.y / b.img_height, b.w / b.img_width, b.h / b.img_height
+    w = min(ax + aw, bx + bw) - max(ax, bx)
+    h = min(ay + ah, by + bh) - max(ay, by)
+    if w <= 0 or h <= 0:
+        return False
+    return w * h / (aw * ah + bw * bh - w * h) >= min_iou
+
+
+def create_face_with_context(face_id: int, collapse_duplicates: bool = False) -> FaceWithContext:
     face_with_similarity = create_face_with_similarity(face_id)
 
-    image_id = face_ctx.faces.faces[face_id].image_id
+    face = face_ctx.faces.faces[face_id]
+    image_id = face.image_id
     image_path = face_ctx.images.images[image_id].best_filename
     image_date = face_ctx.images.images[image_id].capture_date
     if image_date is not None:
         image_date = image_date.strftime("%Y-%m-%d")
 
-    other_faces = face_ctx.get_faces_in_image(image_id)
-    other_faces = [create_face_with_similarity(i) for i in other_faces if i != face_id]
+    other_ids = [i for i in face_ctx.get_faces_in_image(image_id) if i != face_id]
+    duplicate_images = [i for i in duplicate_groups.get(image_id, []) if i != image_id]
+    sibling_faces = [face_ctx.faces.faces[i] for img in duplicate_images for i in face_ctx.get_faces_in_image(img)]
+    duplicate_faces = [f.id for f in sibling_faces if same_place(face, f)]
+    if collapse_duplicates:
+        # people seen on any shot of the group, each place listed once
+        shown = [face] + [face_ctx.faces.faces[i] for i in other_ids]
+        for f in sibling_faces:
+            if not any(same_place(f, s) for s in shown):
+                shown.append(f)
+                other_ids.append(f.id)
 
     return FaceWithContext(
         **face_with_similarity.model_dump(),
-        face_data=face_ctx.faces.faces[face_id],
+        face_data=face,
         image_path=image_path,
         image_date=image_date,
-        other_faces=other_faces
+        other_faces=[create_face_with_similarity(i) for i in other_ids],
+        duplicate_images=duplicate_images,
+        duplicate_faces=duplicate_faces,
     )
 
 
@@ -179,19 +299,22 @@ def create_face_with_context(face_id: int) -> FaceWithContext:
 async def get_similar_faces(face_id: int, count: int = 20, per_bucket: int = 5) -> SimilarFacesResponse:
     """Get similar faces based on embedding distance"""
     try:
-        idx = face_ids.index(face_id)
-        vec = faces[idx]
+        vec = faces[face_rows[face_id]]
 
         # Create query face response
         query_face = create_face_with_similarity(face_id)
 
-        # Calculate cosine similarities
-        distances = 1 - np.dot(faces, vec)
-        most_similar = np.argsort(distances)
+        # Calculate cosine similarities, nearest first
+        if face_index is not None:
+            similar_ids, sims = face_index.search(vec, settings.similar_candidates, settings.nprobe)
+        else:
+            order, sims = similarity.top_k(faces, vec, settings.similar_candidates)
+            similar_ids = [face_ids[i] for i in order]
+        distances = 1 - sims
 
         bucket_list = [[] for _ in range(9)]
-        for num, i in enumerate(most_similar):
-            dist = float(distances[i])  # Convert to Python float
+        for num, (similar_id, dist) in enumerate(zip(similar_ids, distances)):
+            dist = float(dist)  # Convert to Python float
             if dist > 0.6:
                 print(f"done processing {num} faces, cur dist {dist}")
                 break
@@ -199,38 +322,43 @@ async def get_similar_faces(face_id: int, count: int = 20, per_bucket: int = 5)
                 print(f"Skipping {num}th most similar face with distance {dist}")
                 continue
             bucket_idx = int(math.floor(dist / 0.1)-1)
-            bucket_list[bucket_idx].append((i, dist))
+            bucket_list[bucket_idx].append((int(similar_id), dist))
 
         res = []
         for bucket in bucket_list:
             if len(bucket) > 0:
                 sample = random.sample(bucket, min(per_bucket, len(bucket)))
-                for idx, dist in sample:
-                    res.append(create_face_with_similarity(face_ids[idx], dist))
+                for similar_id, dist in sample:
+                    res.append(create_face_with_similarity(similar_id, dist))
             if len(res) >= count:
                 return SimilarFacesResponse(query_face=query_face, similar_faces=res[:count])
         return SimilarFacesResponse(query_face=query_face, similar_faces=res[:count])
-    except ValueError as e:
+    except KeyError as e:
         print(f"Face ID not found: {face_id}: {e}")
         raise HTTPException(status_code=404, detail="Face ID not found")
 
 
 @app.get("/face_with_context/{face_id}")
-async def get_face_with_context(face_id: int, response_model=FaceWithContext):
-    """Get face with context"""
-    return create_face_with_context(face_id)
+async def get_face_with_context(face_id: int, collapse_duplicates: bool = False, response_model=FaceWithContext):
+    """Get face with context; with collapse_duplicates, other faces include those on near-duplicate images"""
+    return create_face_with_context(face_id, collapse_duplicates)
 
 
 @app.get("/face/{face_id}")
 async def get_face_image(face_id: str):
     """Serve face image by ID"""
+    if face_ctx.crops is not None:
+        crop = face_ctx.crops.get(int(face_id)) if face_id.isdigit() else None
+        if crop is not None:
+            return Response(content=crop, media_type=face_ctx.crops.media_type, headers={"Cache-Control": IMMUTABLE_CACHE})
+    # crops that `pack_crops` has not moved into the crop store yet
     image_path = FACES_DIR / f"face_{face_id}.jpg"
     if not image_path.exists():
         raise HTTPException(status_code=404, detail="Image not found")
-    return FileResponse(image_path)
+    return FileResponse(image_path, headers={"Cache-Control": IMMUTABLE_CACHE})
 
 @app.get("/image/{image_id}")
-async def get_image(image_id: str):
+async def get_image(image_id: str, request: Request):
     """Serve image by ID"""
     try:
         image_id = int(image_id)
@@ -239,21 +367,68 @@ async def get_image(image_id: str):
     if image_id not in face_ctx.images.images:
         print(f"Image ID not found in database: {image_id}")
         raise HTTPException(status_code=404, detail="Image not found")
-    image_path = face_ctx.images.images[image_id].best_filename
-    if not Path(image_path).exists():
+    image_path = Path(face_ctx.images.images[image_id].best_filename)
+    if not image_path.exists():
         print(f"Image path not found: {image_path}")
         raise HTTPException(status_code=404, detail="Image not found")
-    # Use images.prepare_image with reasonable max size (1024)
-    prepared = images.get_image(Path(image_path))
-    prepared = images.prepare_image(prepared, max_size=1024)
-    print(f"Serving prepared image: {image_path} resized to max_size 1024")
-    # Convert the numpy array to a JPEG image using PIL
-    img = Image.fromarray(prepared)
-    buf = BytesIO()
-    img.save(buf, format="JPEG")
-    buf.seek(0)
-    content = buf.getvalue()
-    return Response(content=content, media_type="image/jpeg")
+
+    etag = image_cache.image_etag(image_path, IMAGE_MAX_SIZE)
+    mtime = image_path.stat().st_mtime
+    headers = {
+        "ETag": f'"{etag}"',
+        "Last-Modified": formatdate(mtime, usegmt=True),
+        "Cache-Control": "private, max-age=86400",
+    }
+    if not_modified(request, etag, mtime):
+        return Response(status_code=304, headers=headers)
+
+    content = rendered_images.get(etag)
+    if content is None:
+        # decoding takes a while, keep the event loop free for other requests
+        loop = asyncio.get_running_loop()
+        try:
+            content = await loop.run_in_executor(
+                render_pool, image_cache.render_image, image_path, IMAGE_MAX_SIZE, face_ctx.preview_cache_dir)
+        except ValueError as e:
+            print(e)
+            raise HTTPException(status_code=500, detail="Cannot render image")
+        rendered_images.put(etag, content)
+    return Response(content=content, media_type="image/jpeg", headers=headers)
+
+
+def not_modified(request: Request, etag: str, mtime: float) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix('W/').strip('"') for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None:
+        try:
+            return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def prerender_images():
+    """Render context images of all photos with faces into the cache, until its disk budget is nearly used"""
+    image_ids = sorted({face.image_id for face in face_ctx.faces.faces.values()})
+    rendered = rendered_bytes = 0
+    for image_id in image_ids:
+        if rendered_bytes > 0.8 * settings.rendered_cache_bytes:
+            print("Rendered image cache is full, stopping pre-rendering")
+            break
+        image_path = Path(face_ctx.images.images[image_id].best_filename)
+        try:
+            etag = image_cache.image_etag(image_path, IMAGE_MAX_SIZE)
+            if not rendered_images.contains(etag):
+                content = image_cache.render_image(image_path, IMAGE_MAX_SIZE, face_ctx.preview_cache_dir)
+                rendered_images.put(etag, content)
+                rendered += 1
+                rendered_bytes += len(content)
+        except (OSError, ValueError) as e:
+            print(f"Cannot pre-render {image_path}: {e}")
+    print(f"Pre-rendered {rendered} images")
 
 @app.get("/random_component")
 async def get_random_component() -> int:
@@ -263,22 +438,24 @@ async def get_random_component() -> int:
         return await get_random_component()
     return comp_id
 
+def component_neighbor(comp_id: int, distance: float, graph: ComponentGraph) -> dict:
+    return {
+        "comp_id": comp_id,
+        "size": len(components[comp_id]),
+        "sample_face_id": int(graph.medoids[comp_id]),
+        "distance": distance
+    }
+
 @app.get("/component/{comp_id}")
 async def get_component(comp_id: int):
     photo_sample = random.sample(components[comp_id], min(20, len(components[comp_id])))
     neighbors = []
-    if subgraph is not None:
-        neighbors = list(subgraph.neighbors(comp_id))
-        neighbors = sorted(neighbors, key=lambda x: subgraph.edges[comp_id, x]['distance'])
-        neighbors = [
-            {
-                "comp_id": n,
-                "size": len(components[n]),
-                "sample_face_id": random.choice(components[n]),
-                "distance": subgraph.edges[comp_id, n]['distance']
-            }
-            for n in neighbors
-        ]
+    closest = []
+    # a component just split off is missing from the graph until its update is swapped in
+    graph = component_graph if component_graph is not None and comp_id < len(component_graph) else None
+    if graph is not None:
+        neighbors = [component_neighbor(n, dist, graph) for n, dist in graph.neighbours(comp_id, 'centroid')]
+        closest = [component_neighbor(n, dist, graph) for n, dist in graph.neighbours(comp_id, 'linkage')]
 
     # Add person info if assigned
     person = None
@@ -289,47 +466,52 @@ async def get_component(comp_id: int):
         "size": len(components[comp_id]),
         "photos": photo_sample,
         "neighbors": neighbors,
+        "closest_neighbors": closest,
+        "medoid_face_id": int(graph.medoids[comp_id]) if graph is not None else None,
         "person": person
     }
 
-@app.get("/compare-components/{comp_id1}/{comp_id2}")
-async def compare_components(comp_id1: int, comp_id2: int, num_pairs: int = 5):
-    """Compare two components by finding most similar face pairs between them"""
-    # Get faces from both components
-    faces1 = components[comp_id1]
-    faces2 = components[comp_id2]
+def component_rows(comp_id: int) -> np.ndarray:
+    """Rows of `faces` for the faces of a component"""
+    return np.array([face_rows[face_id] for face_id in components[comp_id] if face_id in face_rows], dtype=np.int64)
 
-    # Get embeddings for faces in both components
-    indices1 = [list(face_ids).index(face_id) for face_id in faces1]
-    indices2 = [list(face_ids).index(face_id) for face_id in faces2]
 
-    vecs1 = faces[indices1]
-    vecs2 = faces[indices2]
-
-    # Calculate cosine distance between all pairs
-    distances = 1 - np.dot(vecs1, vecs2.T)
+@app.get("/compare-components/centroids")
+async def compare_component_centroids(comp_ids: List[int] = Query(...)):
+    """Cosine distances between the centroids of several components"""
+    for comp_id in comp_ids:
+        if comp_id >= len(components):
+            raise HTTPException(status_code=404, detail="Component not found")
+    vecs = similarity.centroids(faces, [component_rows(comp_id) for comp_id in comp_ids])
+    distances = 1 - vecs @ vecs.T
+    return {
+        "components": comp_ids,
+        "sizes": [len(components[comp_id]) for comp_id in comp_ids],
+        "distances": distances.round(4).tolist(),
+    }
 
-    # Find top pairs
-    pairs = []
-    for i, j in product(range(len(faces1)), range(len(faces2))):
-        dist = float(distances[i][j])
-        pairs.append((dist, faces1[i], faces2[j]))
 
-    top_pairs = nsmallest(num_pairs, pairs)
+@app.get("/compare-components/{comp_id1}/{comp_id2}")
+async def compare_components(comp_id1: int, comp_id2: int, num_pairs: int = 5):
+    """Compare two components by finding most similar face pairs between them"""
+    rows1 = component_rows(comp_id1)
+    rows2 = component_rows(comp_id2)
+    top1, top2, sims = similarity.top_pairs(faces[rows1], faces[rows2], num_pairs)
 
     return [{
-        "distance": dist,
-        "face1_id": face1_id,
-        "face2_id": face2_id
-    } for dist, face1_id, face2_id in top_pairs]
+        "distance": float(1 - sim),
+        "face1_id": int(face_ids[rows1[i]]),
+        "face2_id": int(face_ids[rows2[j]])
+    } for i, j, sim in zip(top1, top2, sims)]
 
 @app.post("/people")
 async def create_person(person: PersonCreate) -> Person:
     """Create a new person"""
-    new_id = max(people.keys(), default=0) + 1
-    new_person = Person(id=new_id, name=person.name)
-    people[new_id] = new_person
-    save_people()
+    with state.lock:
+        new_id = max(people.keys(), default=0) + 1
+        new_person = Person(id=new_id, name=person.name)
+        people[new_id] = new_person
+    await commit('people')
     return new_person
 
 @app.get("/people")
@@ -395,8 +577,9 @@ async def update_person(person_id: int, person: PersonCreate) -> Person:
     if person_id not in people:
         raise HTTPException(status_code=404, detail="Person not found")
 
-    people[person_id] = Person(id=person_id, name=person.name)
-    save_people()
+    with state.lock:
+        people[person_id] = Person(id=person_id, name=person.name)
+    await commit('people')
     return people[person_id]
 
 @app.delete("/people/{person_id}")
@@ -405,8 +588,9 @@ async def delete_person(person_id: int):
     if person_id not in people:
         raise HTTPException(status_code=404, detail="Person not found")
 
-    del people[person_id]
-    save_people()
+    with state.lock:
+        del people[person_id]
+    await commit('people')
     return {"status": "success"}
 
 @app.put("/component/{comp_id}/person")
@@ -421,8 +605,10 @@ async def assign_person_to_component(comp_id: int, data: ComponentPerson):
         raise HTTPException(status_code=404, detail="Component not found")
 
     # Assign person to component
-    component_people[comp_id] = data.person_id
-    save_component_people()
+    with state.lock:
+        person_index.assign(comp_id, data.person_id, component_people.get(comp_id))
+        component_people[comp_id] = data.person_id
+    await commit('component_people')
 
     return {"status": "success"}
 
@@ -430,8 +616,9 @@ async def assign_person_to_component(comp_id: int, data: ComponentPerson):
 async def remove_person_from_component(comp_id: int):
     """Remove person assignment from a component"""
     if comp_id in component_people:
-        del component_people[comp_id]
-        save_component_people()
+        with state.lock:
+            person_index.unassign(comp_id, component_people.pop(comp_id))
+        await commit('component_people')
 
     return {"status": "success"}
 
@@ -441,10 +628,7 @@ async def get_person_components(person_id: int):
     if person_id not in people:
         raise HTTPException(status_code=404, detail="Person not found")
 
-    assigned_components = [
-        comp_id for comp_id, pid in component_people.items()
-        if pid == person_id
-    ]
+    assigned_components = person_index.components_of(person_id)
 
     return {
         "person": people[person_id],
@@ -460,31 +644,63 @@ async def get_person_components(person_id: int):
 
 
 @app.get("/propose_subdivision/{comp_id}")
-async def propose_subdivision(comp_id: int):
-    """Propose subdivision of a component"""
-    load_graph()
-    subgraph = graph.subgraph([i for i in components[comp_id]])
-    subcomponents = nx.community.louvain_communities(subgraph)
-    ret = []
-    for subcomp in subcomponents:
-        ret.append(list(subcomp))
-
+async def propose_subdivision(comp_id: int, method: str = 'louvain', k: int | None = None):
+    """Propose subdivision of a component, by 'louvain' or 'kmeans' (into k groups)"""
+    if comp_id >= len(components):
+        raise HTTPException(status_code=404, detail="Component not found")
+    if method not in subdivide.METHODS:
+        raise HTTPException(status_code=400, detail=f"Unknown method {method}")
+    key = (comp_id, method, k)
+    if key in subdivisions:
+        subdivisions.move_to_end(key)
+        return {"status": "success", "components": subdivisions[key]}
+
+    members = components[comp_id]
+    member_ids = [face_id for face_id in members if face_id in face_rows]
+    rows = np.array([face_rows[face_id] for face_id in member_ids], dtype=np.int64)
+    # clustering takes a while, keep the event loop free for other requests
+    loop = asyncio.get_running_loop()
+    ret = await loop.run_in_executor(
+        subdivision_pool, subdivide.propose_subdivision, faces, rows, member_ids, method, k)
+    # do not cache a proposal for a component that was subdivided meanwhile
+    if components[comp_id] is members:
+        subdivisions[key] = ret
+        while len(subdivisions) > settings.subdivision_cache_size:
+            subdivisions.popitem(last=False)
     return {"status": "success", "components": ret}
 
 
+def update_component_graph(comp_ids: list[int]) -> None:
+    """Recompute the component graph for changed components on a copy, then swap it in"""
+    global component_graph
+    with graph_lock:
+        with state.lock:
+            snapshot = list(components)
+        graph = component_graph.copy()
+        graph.update(faces, face_rows, snapshot, comp_ids)
+        with state.lock:
+            component_graph = graph
+
+
 @app.post("/component/{comp_id}/subdivide")
 async def submit_subdivision(comp_id: int, remove_indices: List[int]):
     """Handle subdivision of a component based on user feedback"""
     print(f"submitting subdivision for component {comp_id} with indices {remove_indices}")
-    remove_indices = set(remove_indices)
-    src_comp = [i for i in components[comp_id] if i not in remove_indices]
-    components[comp_id] = src_comp
-    components.append(list(remove_indices))
-    new_component_id = len(components)-1
-    for face in remove_indices:
-        face_to_component[face] = new_component_id
-    with open(settings.subgraph_dir / f"louvain_communities.json", 'w') as f:
-        json.dump(components, f, indent=4)
+    with state.lock:
+        # faces moved elsewhere by a concurrent edit stay where they are
+        remove_indices = set(remove_indices) & set(components[comp_id])
+        src_comp = [i for i in components[comp_id] if i not in remove_indices]
+        components[comp_id] = src_comp
+        components.append(sorted(remove_indices))
+        new_component_id = len(components)-1
+        for face in remove_indices:
+            face_to_component[face] = new_component_id
+        person_index.subdivide(comp_id, new_component_id, component_people.get(comp_id))
+    for key in [key for key in subdivisions if key[0] in (comp_id, new_component_id)]:
+        del subdivisions[key]
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(subdivision_pool, update_component_graph, [comp_id, new_component_id])
+    await commit('components', 'component_graph')
     return {"status": "success", "new_component": new_component_id}
 
 class TimelineFace(BaseModel):
@@ -498,57 +714,40 @@ async def get_person_timeline(
     person_id: int,
     page: int = 1,
     page_size: int = 20,
-    sort_order: str = "desc"
+    sort_order: str = "desc",
+    after: int | None = None
 ):
-    """Get chronological timeline of faces for a person"""
-    person_id = int(person_id)
+    """Get chronological timeline of faces for a person
+
+    Pages are numbered from 1; `after` continues after the given face instead,
+    which stays stable while faces are added or removed.
+    """
     if person_id not in people:
         raise HTTPException(status_code=404, detail="Person not found")
 
-    # Get all components assigned to this person
-    assigned_components = [
-        comp_id for comp_id, pid in component_people.items()
-        if pid == person_id
+    descending = sort_order == "desc"
+    with state.lock:
+        if after is not None:
+            start_idx = person_index.position_after(person_id, after, descending)
+        else:
+            start_idx = (page - 1) * page_size
+        entries = person_index.page(person_id, start_idx, page_size, descending)
+        total_faces = len(person_index.faces_of(person_id))
+
+    faces_with_dates = [
+        TimelineFace(
+            face_id=face_id,
+            image_date=image_date or None,
+            image_path=face_ctx.images.images[face_ctx.faces.faces[face_id].image_id].best_filename,
+            component_id=comp_id
+        )
+        for _, image_date, face_id, comp_id in entries
     ]
 
-    # Collect all faces from these components with their dates
-    faces_with_dates = []
-    for comp_id in assigned_components:
-        for face_id in components[comp_id]:
-            # Get image date for this face
-            print(f"face_id: {face_id}={type(face_id)}")
-            image_id = face_ctx.faces.faces[face_id].image_id
-            image_path = face_ctx.images.images[image_id].best_filename
-            image_date = face_ctx.images.images[image_id].capture_date
-
-            if image_date is not None:
-                image_date = image_date.strftime("%Y-%m-%d")
-
-            faces_with_dates.append(
-                TimelineFace(
-                    face_id=face_id,
-                    image_date=image_date,
-                    image_path=image_path,
-                    component_id=comp_id
-                )
-            )
-
-    # Sort faces by date
-    faces_with_dates.sort(
-        key=lambda x: (x.image_date is None, x.image_date),
-        reverse=(sort_order == "desc")
-    )
-
-    # Calculate pagination
-    total_faces = len(faces_with_dates)
-    total_pages = math.ceil(total_faces / page_size)
-    start_idx = (page - 1) * page_size
-    end_idx = start_idx + page_size
-
     return {
-        "faces": faces_with_dates[start_idx:end_idx],
+        "faces": faces_with_dates,
         "total_count": total_faces,
-        "has_more": page < total_pages
+        "has_more": start_idx + page_size < total_faces
     }
 
 # Serve index.html as a last resort (on all other paths)
@@ -0,0 +1,75 @@
+import sys
+from bisect import bisect_left, bisect_right
+from heapq import merge
+from typing import Callable
+
+# timeline entry: (no date, date, face id, component id); faces without a date sort last
+Entry = tuple[bool, str, int, int]
+
+
+class PersonIndex:
+    """Inverse indexes of the component -> person assignment.
+
+    Keeps the components of every person and, built on first use, the faces
+    of every person sorted by capture date. Both are updated on assign,
+    unassign and subdivide, so the timeline is a slice of a ready list.
+    """
+
+    def __init__(self, components: list[list[int]], component_people: dict[int, int],
+                 face_date: Callable[[int], str | None]):
+        self.components = components
+        self.face_date = face_date
+        self.person_components: dict[int, set[int]] = {}
+        self.person_faces: dict[int, list[Entry]] = {}
+        for comp_id, person_id in component_people.items():
+            self.person_components.setdefault(person_id, set()).add(comp_id)
+
+    def entry(self, face_id: int, comp_id: int) -> Entry:
+        date = self.face_date(face_id)
+        return (date is None, date or '', face_id, comp_id)
+
+    def _entries(self, comp_id: int, face_ids=None) -> list[Entry]:
+        face_ids = self.components[comp_id] if face_ids is None else face_ids
+        return sorted(self.entry(face_id, comp_id) for face_id in face_ids)
+
+    def components_of(self, person_id: int) -> list[int]:
+        return sorted(self.person_components.get(person_id, ()))
+
+    def faces_of(self, person_id: int) -> list[Entry]:
+        if person_id not in self.person_faces:
+            entries = [e for comp_id in self.components_of(person_id) for e in self._entries(comp_id)]
+            self.person_faces[person_id] = sorted(entries)
+        return self.person_faces[person_id]
+
+    def assign(self, comp_id: int, person_id: int, previous: int | None = None) -> None:
+        if previous is not None:
+            self.unassign(comp_id, previous)
+        self.person_components.setdefault(person_id, set()).add(comp_id)
+        if person_id in self.person_faces:
+            self.person_faces[person_id] = list(merge(self.person_faces[person_id], self._entries(comp_id)))
+
+    def unassign(self, comp_id: int, person_id: int) -> None:
+        self.person_components.get(person_id, set()).discard(comp_id)
+        if person_id in self.person_faces:
+            self.person_faces[person_id] = [e for e in self.person_faces[person_id] if e[3] != comp_id]
+
+    def subdivide(self, comp_id: int, new_comp_id: int, person_id: int | None) -> None:
+        """Faces of the unassigned `new_comp_id` were moved out of `comp_id`, assigned to `person_id`."""
+        if person_id is not None and person_id in self.person_faces:
+            moved = set(self.components[new_comp_id])
+            self.person_faces[person_id] = [e for e in self.person_faces[person_id] if e[2] not in moved]
+
+    def page(self, person_id: int, start: int, count: int, descending: bool = False) -> list[Entry]:
+        entries = self.faces_of(person_id)
+        if not descending:
+            return entries[start:start + count]
+        end = len(entries) - start
+        return entries[max(end - count, 0):max(end, 0)][::-1]
+
+    def position_after(self, person_id: int, face_id: int, descending: bool = False) -> int:
+        """Offset of the first entry after `face_id` in the requested order; the face need not be listed any more."""
+        no_date, date, _, _ = self.entry(face_id, 0)
+        entries = self.faces_of(person_id)
+        if descending:
+            return len(entries) - bisect_left(entries, (no_date, date, face_id, -1))
+        return bisect_right(entries, (no_date, date, face_id, sys.maxsize))
@@ -0,0 +1,62 @@
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable
+
+
+class StateStore:
+    """Single writer for the curation state of the server.
+
+    Handlers change the in-memory state while holding `lock` and then call
+    `commit()` with the names of the parts they touched. A background thread
+    saves the dirty parts from snapshots taken under the lock; everything
+    committed while a save is running goes into the next one, so a burst of
+    edits costs one atomic write and fsync per file. The future returned by
+    `commit()` completes once the change is on disk.
+    """
+
+    def __init__(self, parts: dict[str, tuple[Callable[[], Any], Callable[[Any], None]]], delay: float = 0.02):
+        # name -> (take a snapshot, called under the lock; write the snapshot, called on the writer thread)
+        self.parts = parts
+        self.delay = delay
+        self.lock = threading.RLock()
+        self.changed = threading.Condition(self.lock)
+        self.dirty: set[str] = set()
+        self.unsaved: set[str] = set()
+        self.waiters: list[Future] = []
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def commit(self, *parts: str) -> Future:
+        """Schedule a save of `parts`; without parts the future just waits for pending saves."""
+        future = Future()
+        with self.changed:
+            self.dirty.update(parts)
+            self.waiters.append(future)
+            self.changed.notify()
+        return future
+
+    def _run(self) -> None:
+        while True:
+            with self.changed:
+                while not self.waiters:
+                    self.changed.wait()
+            # let concurrent edits join this batch
+            time.sleep(self.delay)
+            with self.lock:
+                # parts whose last save failed are retried with the next batch
+                dirty = self.dirty | self.unsaved
+                self.dirty, self.unsaved = set(), set()
+                waiters, self.waiters = self.waiters, []
+                snapshots = {name: self.parts[name][0]() for name in dirty}
+            try:
+                for name, snapshot in snapshots.items():
+                    self.parts[name][1](snapshot)
+            except Exception as e:
+                print(f"Cannot save {', '.join(snapshots)}: {e}")
+                with self.lock:
+                    self.unsaved |= dirty
+                for future in waiters:
+                    future.set_exception(e)
+            else:
+                for future in waiters:
+                    future.set_result(None)
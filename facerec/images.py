@@ -1,4 +1,10 @@
 import io
+import hashlib
+import math
+import os
+import struct
+import threading
+from functools import lru_cache
 from pathlib import Path
 import numpy as np
 import rawpy
@@ -47,18 +53,225 @@ def get_thumb_image(path: Path) -> np.ndarray:
             image = rot_cw(image)
     return image
 
-def get_jpeg_image(path: Path) -> np.ndarray:
-    img = Image.open(path)
+# previews of RAW files are cached with this longest side, large enough for detection and /image
+PREVIEW_SIZE = 1280
+# disk budget of the RAW preview cache
+PREVIEW_CACHE_BYTES = 4 * 1024 ** 3
+
+TIFF_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 7: 1, 9: 4, 10: 8, 13: 4}
+EXIF_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+
+def read_tiff_previews(path: Path) -> tuple[list[bytes], int]:
+    """Return the JPEG previews embedded in a TIFF-based RAW file (NEF, ARW) and its orientation.
+
+    Walks IFD0, its chain and all SubIFDs looking for
+    JPEGInterchangeFormat/JPEGInterchangeFormatLength pairs.
+    """
+    with open(path, 'rb') as f:
+        data = f.read(8)
+        if data[:2] == b'II':
+            endian = '<'
+        elif data[:2] == b'MM':
+            endian = '>'
+        else:
+            return [], 1
+        if struct.unpack(endian + 'H', data[2:4])[0] != 42:
+            return [], 1
+
+        def read_values(type_, count, raw):
+            size = TIFF_TYPE_SIZES.get(type_, 1) * count
+            if size > 4:
+                f.seek(struct.unpack(endian + 'I', raw)[0])
+                raw = f.read(size)
+            if type_ == 3:
+                return struct.unpack(endian + 'H' * count, raw[:2 * count])
+            if type_ in (4, 13):
+                return struct.unpack(endian + 'I' * count, raw[:4 * count])
+            return ()
+
+        previews = []
+        orientation = 1
+        ifd0 = struct.unpack(endian + 'I', data[4:8])[0]
+        queue = [ifd0]
+        seen = set()
+        while queue:
+            offset = queue.pop()
+            if offset == 0 or offset in seen or len(seen) > 64:
+                continue
+            seen.add(offset)
+            f.seek(offset)
+            count = struct.unpack(endian + 'H', f.read(2))[0]
+            entries = [struct.unpack(endian + 'HHI4s', f.read(12)) for _ in range(count)]
+            next_ifd = f.read(4)
+            if len(next_ifd) == 4:
+                queue.append(struct.unpack(endian + 'I', next_ifd)[0])
+            tags = {}
+            for tag, type_, n, raw in entries:
+                if tag in (0x0112, 0x0201, 0x0202, 0x014A):
+                    tags[tag] = read_values(type_, n, raw)
+            if offset == ifd0 and tags.get(0x0112):
+                orientation = tags[0x0112][0]
+            queue.extend(tags.get(0x014A, ()))
+            if tags.get(0x0201) and tags.get(0x0202):
+                f.seek(tags[0x0201][0])
+                jpeg = f.read(tags[0x0202][0])
+                if jpeg[:2] == b'\xff\xd8':
+                    previews.append(jpeg)
+    return previews, orientation
+
+
+def open_draft(src, max_size: int | None) -> Image.Image:
+    """Open an image, letting JPEG decoding skip detail beyond `max_size` on the longest side."""
+    img = Image.open(src)
+    if max_size is not None:
+        scale = max_size / max(img.size)
+        if scale < 1:
+            img.draft(img.mode, (math.ceil(img.width * scale), math.ceil(img.height * scale)))
+    return img
+
+
+def get_raw_preview(path: Path, max_size: int | None = None) -> np.ndarray:
+    previews, orientation = read_tiff_previews(path)
+    if not previews:
+        return get_thumb_image(path)
+    # the smallest preview that is still large enough, otherwise the largest one
+    sized = sorted((max(Image.open(io.BytesIO(p)).size), len(p), p) for p in previews)
+    best = sized[-1][2]
+    if max_size is not None:
+        for size, _, preview in sized:
+            if size >= max_size:
+                best = preview
+                break
+    img = open_draft(io.BytesIO(best), max_size)
+    if orientation in EXIF_TRANSPOSE:
+        img = img.transpose(EXIF_TRANSPOSE[orientation])
+    return np.array(img)
+
+
+def get_jpeg_image(path: Path, max_size: int | None = None) -> np.ndarray:
+    img = open_draft(path, max_size)
     img = ImageOps.exif_transpose(img)
     arr = np.array(img)
     return arr
 
-def get_image(path: Path) -> np.ndarray | None:
+
+def get_full_size(path: Path) -> tuple[int, int] | None:
+    """(width, height) of a JPEG at full resolution, upright, from its header; None for RAW files."""
+    if path.suffix.lower() not in models.JPG_EXTENSIONS:
+        return None
+    try:
+        with Image.open(path) as img:
+            width, height = img.size
+            if img.getexif().get(0x0112) in (5, 6, 7, 8):
+                return height, width
+    except OSError:
+        return None
+    return width, height
+
+
+class CacheBudget:
+    """Disk budget of a cache directory of `<xx>/<key>.jpg` files, evicting least recently used files.
+
+    Cache hits should `touch()` their file, so that modification times order
+    files by last use. The size is scanned on first use and then tracked per
+    process; once it exceeds `max_bytes`, the oldest files are deleted until
+    the cache is down to 90% of the budget.
+    """
+
+    def __init__(self, cache_dir: Path, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.size: int | None = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def touch(fname: Path) -> None:
+        try:
+            os.utime(fname)
+        except OSError:
+            pass
+
+    def _files(self) -> list[tuple[float, int, str]]:
+        files = []
+        for fname in self.cache_dir.glob('*/*.jpg'):
+            try:
+                stat = fname.stat()
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, str(fname)))
+        return files
+
+    def added(self, nbytes: int) -> None:
+        with self.lock:
+            if self.size is None:
+                self.size = sum(size for _, size, _ in self._files())
+            else:
+                self.size += nbytes
+            if self.size <= self.max_bytes:
+                return
+            files = sorted(self._files())
+            self.size = sum(size for _, size, _ in files)
+            for _, size, fname in files:
+                if self.size <= 0.9 * self.max_bytes:
+                    break
+                try:
+                    os.remove(fname)
+                except OSError:
+                    continue
+                self.size -= size
+
+
+@lru_cache(maxsize=None)
+def preview_budget(cache_dir: Path) -> CacheBudget:
+    return CacheBudget(cache_dir, PREVIEW_CACHE_BYTES)
+
+
+def get_cached_preview(path: Path, cache_dir: Path) -> np.ndarray:
+    """RAW preview with PREVIEW_SIZE longest side, cached on disk by path, mtime and size."""
+    stat = path.stat()
+    key = hashlib.sha1(f'{path.absolute()}:{stat.st_mtime_ns}:{stat.st_size}:{PREVIEW_SIZE}'.encode()).hexdigest()
+    fname = cache_dir / key[:2] / f'{key}.jpg'
+    try:
+        with Image.open(fname) as img:
+            image = np.array(img)
+        CacheBudget.touch(fname)
+        return image
+    except FileNotFoundError:
+        pass
+    img = Image.fromarray(get_raw_preview(path, PREVIEW_SIZE))
+    img.thumbnail((PREVIEW_SIZE, PREVIEW_SIZE))
+    fname.parent.mkdir(parents=True, exist_ok=True)
+    tmp = fname.with_suffix(f'.{os.getpid()}.{threading.get_ident()}.tmp')
+    img.save(tmp, format='JPEG', quality=95)
+    os.replace(tmp, fname)
+    preview_budget(cache_dir).added(fname.stat().st_size)
+    return np.array(img)
+
+
+def get_image(path: Path, max_size: int | None = None, cache_dir: Path | None = None) -> np.ndarray | None:
+    """Load an image as RGB (or grayscale) array.
+
+    With `max_size`, decoding may stop at a reduced resolution whose longest
+    side is still at least `max_size`; the caller does any further resizing.
+    With `cache_dir`, such reduced RAW previews are cached on disk.
+    """
     try:
         if path.suffix.lower() in models.RAW_EXTENSIONS:
-            image = get_thumb_image(path)
+            if cache_dir is not None and max_size is not None and max_size <= PREVIEW_SIZE:
+                image = get_cached_preview(path, cache_dir)
+            else:
+                image = get_raw_preview(path, max_size)
         if path.suffix.lower() in models.JPG_EXTENSIONS:
-            image = get_jpeg_image(path)
+            image = get_jpeg_image(path, max_size)
         return image
     except Exception as e:
         print(f"Error loading image {path}: {e}")
@@ -1,9 +1,14 @@
+import os
+import json
 from pathlib import Path
 from datetime import datetime
 import cv2
 from pydantic import BaseModel
 import numpy as np
 from collections import defaultdict
+
+from facerec.embeddings import EmbeddingStore
+from facerec.crop_store import CropStore
 RAW_EXTENSIONS = {'.nef', '.arw'}
 JPG_EXTENSIONS = {'.jpg', '.jpeg'}
 
@@ -14,6 +19,9 @@ class Image(BaseModel):
     capture_date: datetime | None
     discovered_at: datetime
     faces_detected_at: datetime | None = None
+    # perceptual hash (hex) and the image this one is a near-duplicate of, set by `dedup`
+    phash: str | None = None
+    duplicate_of: int | None = None
 
 
 class File(BaseModel):
@@ -32,7 +40,7 @@ class Face(BaseModel):
     y: int
     w: int
     h: int
-    emb: list[float] | None
+    emb: list[float] | None = None  # legacy: embeddings now live in the EmbeddingStore
     face_data: str
 
 
@@ -41,75 +49,164 @@ class Component(BaseModel):
     faces: list[int]
 
 
-class Images:
+class JsonlStore:
+    """Records of one model type kept in `<name>.jsonl` plus an append-only journal.
+
+    `write()` appends only added or `mark_dirty()`-ed records to
+    `<name>.journal.jsonl`; once the journal grows past `compact_ratio` of
+    the records, everything is rewritten to `<name>.compacted.jsonl`, the
+    journal is removed and the compacted file atomically replaces the main
+    file; a compaction interrupted after the compacted file was complete is
+    finished on load. On load the journal is replayed over the main file,
+    later lines winning.
+    """
+    name: str
+    model: type[BaseModel]
+    compact_ratio = 0.25
+    compact_min = 1000
+
     def __init__(self, data_root: Path):
         self.data_root = data_root
-        self.images = self.read()
-        self.next_id = max(self.images.keys()) + 1 if self.images else 1
+        self.fname = data_root / f'{self.name}.jsonl'
+        self.journal_fname = data_root / f'{self.name}.journal.jsonl'
+        self.compacted_fname = data_root / f'{self.name}.compacted.jsonl'
+        self.dirty: set[int] = set()
+        self.journal_size = 0
+        self.damaged = False
+        self.records = self.read()
 
-    def read(self) -> dict[int, Image]:
-        fname = self.data_root / 'images.jsonl'
+    def read_file(self, fname: Path, records: dict) -> int:
         if not fname.exists():
-            return {}
+            return 0
+        count = 0
         with open(fname, 'r') as f:
-            images = {}
             for line in f:
-                img = Image.model_validate_json(line)
-                images[img.id] = img
-            return images
+                try:
+                    record = self.model.model_validate_json(line)
+                except ValueError:
+                    # a crash mid-append can leave a partial last line
+                    print(f"Skipping unreadable record in {fname}")
+                    self.damaged = True
+                    continue
+                records[record.id] = record
+                count += 1
+        return count
+
+    def read(self) -> dict:
+        if self.compacted_fname.exists():
+            self.finish_compaction()
+        records = {}
+        self.read_file(self.fname, records)
+        self.journal_size = self.read_file(self.journal_fname, records)
+        return records
+
+    def dump(self, record: BaseModel) -> str:
+        return record.model_dump_json()
+
+    def mark_dirty(self, id: int) -> None:
+        self.dirty.add(id)
 
     def write(self) -> None:
-        fname = self.data_root / 'images.jsonl'
-        with open(fname, 'w') as f:
-            for img in self.images.values():
-                f.write(img.model_dump_json() + '\n')
-
-    def add(self, image: Image) -> None:
-        if image.id == 0:
-            image.id = self.next_id
+        if not self.fname.exists() or self.damaged or self.journal_size + len(self.dirty) > max(
+                self.compact_min, self.compact_ratio * len(self.records)):
+            self.compact()
+            return
+        if not self.dirty:
+            return
+        with open(self.journal_fname, 'a') as f:
+            for id in sorted(self.dirty):
+                f.write(self.dump(self.records[id]) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.journal_size += len(self.dirty)
+        self.dirty.clear()
+
+    def compact(self) -> None:
+        tmp = self.fname.with_suffix('.jsonl.tmp')
+        with open(tmp, 'w') as f:
+            for record in self.records.values():
+                f.write(self.dump(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        # the complete file gets its own name first; from then on the journal is obsolete
+        os.replace(tmp, self.compacted_fname)
+        self.finish_compaction()
+        self.journal_size = 0
+        self.damaged = False
+        self.dirty.clear()
+
+    def finish_compaction(self) -> None:
+        """Drop the journal, then move the compacted file in place; repeated on load after a crash."""
+        self.journal_fname.unlink(missing_ok=True)
+        os.replace(self.compacted_fname, self.fname)
+
+    def add(self, record: BaseModel) -> None:
+        if record.id == 0:
+            record.id = self.next_id
             self.next_id += 1
-        self.images[image.id] = image
+        self.records[record.id] = record
+        self.dirty.add(record.id)
+
 
+class Images(JsonlStore):
+    name = 'images'
+    model = Image
 
-class Faces:
     def __init__(self, data_root: Path):
-        self.data_root = data_root
-        self.faces = self.read()
-        self.next_id = max(self.faces.keys()) + 1 if self.faces else 1
+        super().__init__(data_root)
+        self.images: dict[int, Image] = self.records
+        self.next_id = max(self.images.keys()) + 1 if self.images else 1
 
-    def read(self) -> dict[int, Face]:
-        fname = self.data_root / 'faces.jsonl'
-        if not fname.exists():
-            return {}
-        with open(fname, 'r') as f:
-            faces = {}
-            for line in f:
-                face = Face.model_validate_json(line)
-                faces[face.id] = face
-            return faces
+    def duplicate_links(self) -> dict[int, int]:
+        """Image id -> id of its representative, for images linked by `dedup`."""
+        return {img.id: img.duplicate_of for img in self.images.values() if img.duplicate_of is not None}
 
-    def write(self) -> None:
-        fname = self.data_root / 'faces.jsonl'
-        with open(fname, 'w') as f:
-            for face in self.faces.values():
-                f.write(face.model_dump_json() + '\n')
+
+class Faces(JsonlStore):
+    name = 'faces'
+    model = Face
+
+    def __init__(self, data_root: Path):
+        super().__init__(data_root)
+        self.faces: dict[int, Face] = self.records
+        self.next_id = max(self.faces.keys()) + 1 if self.faces else 1
+        self.img2faces = defaultdict(list)
+        for face in self.faces.values():
+            self.img2faces[face.image_id].append(face.id)
 
     def add(self, face: Face) -> None:
-        if face.id == 0:
-            face.id = self.next_id
-            self.next_id += 1
-        self.faces[face.id] = face
+        super().add(face)
+        self.img2faces[face.image_id].append(face.id)
+
+    def by_image(self, image_id: int) -> list[int]:
+        return self.img2faces.get(image_id, [])
+
+    def dump(self, face: Face) -> str:
+        exclude = {'emb'} if face.emb is None else None
+        return face.model_dump_json(exclude=exclude)
 
 class Context:
     def __init__(self, data_root: Path):
         print(data_root)
         self.data_root = data_root
-        (data_root / 'faces_extr').mkdir(exist_ok=True, parents=True)
-        self.images = Images(data_root)
-        self.faces = Faces(data_root)
-        self.img2faces = defaultdict(list)
-        for face in self.faces.faces.values():
-            self.img2faces[face.image_id].append(face.id)
+        self.preview_cache_dir = data_root / 'preview_cache'
+        self.db = None
+        if (data_root / 'facerec.db').exists():
+            from facerec.sqlite_store import Database
+            self.db = Database(data_root)
+            self.images = self.db.images
+            self.faces = self.db.faces
+            self.embeddings = self.db.embeddings
+        else:
+            self.images = Images(data_root)
+            self.faces = Faces(data_root)
+            self.embeddings = EmbeddingStore(data_root)
+        # databases from before the crop store keep one JPEG per face until `pack_crops`;
+        # databases without faces get a crop store once they save their first crop
+        self.crops = CropStore.open(data_root)
+        self.new_database = self.crops is None and len(self.faces.faces) == 0
+        if self.crops is None and not self.new_database:
+            (data_root / 'faces_extr').mkdir(exist_ok=True, parents=True)
 
     def save(self) -> None:
         self.save_images()
@@ -119,21 +216,113 @@ class Context:
         self.images.write()
 
     def save_faces(self) -> None:
+        self.embeddings.flush()
+        if self.crops is not None:
+            self.crops.flush()
         self.faces.write()
 
     def save_extracted_face(self, id: int, face: np.ndarray) -> None:
+        if self.crops is None and self.new_database:
+            self.crops = CropStore.open(self.data_root, new=True)
+        if self.crops is not None:
+            self.crops.add(id, face)
+            return
         fname = self.data_root / 'faces_extr' / f'face_{id}.jpg'
         face_img_bgr = face[..., ::-1]
         cv2.imwrite(str(fname), face_img_bgr)
 
-    def get_embeddings(self) -> tuple[np.ndarray, list[int]]:
-        face_ids = sorted(self.faces.faces.keys())
-        r = []
-        for id in face_ids:
-            r.append(self.faces.faces[id].emb)
-        faces = np.array(r)
-        faces = faces / np.linalg.norm(faces, axis=1)[:, None]
+    def get_embeddings(self, face_ids: list[int] | None = None) -> tuple[np.ndarray, list[int]]:
+        if face_ids is None:
+            face_ids = sorted(self.faces.faces.keys())
+        self.embeddings.flush()
+        rows = np.array([self.embeddings.rows.get(id, -1) for id in face_ids], dtype=np.int64)
+        matrix = self.embeddings.matrix()
+        if len(rows) == matrix.shape[0] and np.array_equal(rows, np.arange(len(rows))):
+            return np.asarray(matrix, dtype=np.float32), face_ids
+        faces = np.empty((len(face_ids), self.embeddings.dim), dtype=np.float32)
+        stored = rows >= 0
+        faces[stored] = matrix[rows[stored]]
+        # faces that were not migrated to the embedding store yet
+        for i in np.nonzero(~stored)[0]:
+            emb = np.array(self.faces.faces[face_ids[i]].emb)
+            faces[i] = emb / np.linalg.norm(emb)
         return faces, face_ids
 
     def get_faces_in_image(self, image_id: int) -> list[int]:
-        return self.img2faces[image_id]
+        return self.faces.by_image(image_id)
+
+    def load_components(self) -> list[list[int]]:
+        if self.db is not None:
+            return self.db.load_components()
+        fname = self.data_root / 'louvain_communities.json'
+        if not fname.exists():
+            return []
+        with open(fname, 'r') as f:
+            return [[int(face_id) for face_id in component] for component in json.load(f)]
+
+    def save_components(self, components: list[list[int]]) -> None:
+        if self.db is not None:
+            return self.db.save_components(components)
+        write_json(self.data_root / 'louvain_communities.json',
+                   [[int(face_id) for face_id in component] for component in components])
+
+    def load_people(self) -> dict[int, str]:
+        if self.db is not None:
+            return self.db.load_people()
+        fname = self.data_root / 'people.json'
+        if not fname.exists():
+            return {}
+        with open(fname, 'r') as f:
+            return {int(k): v for k, v in json.load(f).items()}
+
+    def save_people(self, people: dict[int, str]) -> None:
+        if self.db is not None:
+            return self.db.save_people(people)
+        write_json(self.data_root / 'people.json', people)
+
+    def load_component_people(self) -> dict[int, int]:
+        if self.db is not None:
+            return self.db.load_component_people()
+        fname = self.data_root / 'component_people.json'
+        if not fname.exists():
+            return {}
+        with open(fname, 'r') as f:
+            return {int(k): int(v) for k, v in json.load(f).items()}
+
+    def save_component_people(self, component_people: dict[int, int]) -> None:
+        if self.db is not None:
+            return self.db.save_component_people(component_people)
+        write_json(self.data_root / 'component_people.json', component_people)
+
+
+def write_json(fname: Path, data) -> None:
+    """Write a JSON file so that a crash leaves either the old or the new version."""
+    tmp = fname.with_suffix('.json.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, fname)
+
+
+def migrate_embeddings(data_root: Path, dtype: str = 'float32') -> None:
+    """Move embeddings out of faces.jsonl into the embedding store."""
+    ctx = Context(data_root)
+    if ctx.db is not None:
+        print("SQLite databases keep embeddings in the database already")
+        return
+    if len(ctx.embeddings) == 0:
+        ctx.embeddings = EmbeddingStore(data_root, dtype=dtype)
+    elif ctx.embeddings.dtype != dtype:
+        print(f"Embedding store already uses {ctx.embeddings.dtype}, keeping it")
+    migrated = 0
+    for face in ctx.faces.faces.values():
+        if face.emb is None:
+            continue
+        if face.id not in ctx.embeddings.rows:
+            ctx.embeddings.add(face.id, np.array(face.emb))
+        face.emb = None
+        migrated += 1
+    ctx.embeddings.flush()
+    ctx.faces.compact()
+    print(f"Migrated {migrated} embeddings")
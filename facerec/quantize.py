@@ -0,0 +1,198 @@
+from pathlib import Path
+from dataclasses import replace
+import random
+import shutil
+import tempfile
+import time
+import numpy as np
+import tqdm
+
+from facerec import models, similarity
+from facerec import detect_faces
+from facerec.detect_faces import AnalyzerConfig
+from facerec.embeddings import encode, decode
+
+REPORT_FILE = 'quantization_report.json'
+QUANTIZED_TASKS = ('detection', 'recognition')
+
+
+class _RecordingSession:
+    """Wraps an onnxruntime session and keeps the inputs of every run, for calibration."""
+
+    def __init__(self, session):
+        self.session = session
+        self.feeds: list[dict[str, np.ndarray]] = []
+
+    def run(self, output_names, input_feed, *args, **kwargs):
+        self.feeds.append(input_feed)
+        return self.session.run(output_names, input_feed, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+
+def _sample_images(ctx: models.Context, count: int, seed: int) -> list[int]:
+    """Up to `count` random images that have faces."""
+    image_ids = sorted({face.image_id for face in ctx.faces.faces.values()})
+    return random.Random(seed).sample(image_ids, min(count, len(image_ids)))
+
+
+def _load(ctx: models.Context, image_id: int, config: AnalyzerConfig) -> np.ndarray | None:
+    return detect_faces.load_image(ctx.images.images[image_id], config.decode_size, ctx.preview_cache_dir)
+
+
+def quantize_models(data_root: Path, config: AnalyzerConfig = AnalyzerConfig(), images: int = 50,
+                    seed: int = 0, per_channel: bool = True) -> Path:
+    """Write int8 versions of the detection and recognition models next to the fp32 model pack.
+
+    The models are quantized statically, with activation ranges calibrated
+    on the detector and recognizer inputs of `images` random photos of the
+    collection that have faces. Other models of the pack are copied as they
+    are. Returns the directory of the quantized pack.
+    """
+    from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_static
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    class Feeds(CalibrationDataReader):
+        def __init__(self, feeds):
+            self.feeds = iter(feeds)
+
+        def get_next(self):
+            return next(self.feeds, None)
+
+    ctx = models.Context(data_root)
+    config = replace(config, quantized=False, modules=QUANTIZED_TASKS)
+    analyzer = detect_faces.create_analyzer(config)
+    recorders = {}
+    for task in QUANTIZED_TASKS:
+        recorders[task] = analyzer.models[task].session = _RecordingSession(analyzer.models[task].session)
+    for image_id in tqdm.tqdm(_sample_images(ctx, images, seed), desc="Calibration images"):
+        detect_faces.detect(analyzer, _load(ctx, image_id, config))
+
+    src = detect_faces.MODEL_ROOT / 'models' / config.model_name
+    dst = detect_faces.MODEL_ROOT / 'models' / detect_faces.model_pack(replace(config, quantized=True))
+    dst.mkdir(parents=True, exist_ok=True)
+    quantized = {Path(analyzer.models[task].model_file).name: task for task in QUANTIZED_TASKS}
+    for model_file in sorted(src.glob('*.onnx')):
+        task = quantized.get(model_file.name)
+        if task is None:
+            shutil.copy(model_file, dst / model_file.name)
+            continue
+        print(f"Quantizing {task} model {model_file.name} on {len(recorders[task].feeds)} inputs")
+        with tempfile.TemporaryDirectory() as tmp:
+            prepared = Path(tmp) / model_file.name
+            quant_pre_process(str(model_file), str(prepared))
+            quantize_static(str(prepared), str(dst / model_file.name), Feeds(recorders[task].feeds),
+                            quant_format=QuantFormat.QDQ, per_channel=per_channel,
+                            activation_type=QuantType.QInt8, weight_type=QuantType.QInt8)
+    print(f"Quantized models written to {dst}")
+    return dst
+
+
+def _iou(a: np.ndarray, b: np.ndarray) -> float:
+    w = max(0.0, min(a[2], b[2]) - max(a[0], b[0]))
+    h = max(0.0, min(a[3], b[3]) - max(a[1], b[1]))
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - w * h
+    return w * h / union if union > 0 else 0.0
+
+
+def _match_faces(ref: list, test: list, min_iou: float = 0.5) -> list[tuple[int, int]]:
+    """Greedy one-to-one matching of detections by bounding box overlap."""
+    pairs = sorted(((_iou(r.bbox, t.bbox), i, j) for i, r in enumerate(ref) for j, t in enumerate(test)), reverse=True)
+    used_ref, used_test, matches = set(), set(), []
+    for iou, i, j in pairs:
+        if iou < min_iou:
+            break
+        if i not in used_ref and j not in used_test:
+            used_ref.add(i)
+            used_test.add(j)
+            matches.append((i, j))
+    return matches
+
+
+def _summary(values: np.ndarray) -> dict[str, float]:
+    return {'mean': float(values.mean()), 'p5': float(np.percentile(values, 5)), 'min': float(values.min())}
+
+
+def _normalize(vecs: np.ndarray) -> np.ndarray:
+    vecs = np.asarray(vecs, dtype=np.float32)
+    norms = np.linalg.norm(vecs, axis=1, keepdims=True)
+    return vecs / np.where(norms > 0, norms, 1)
+
+
+def compare_models(data_root: Path, config: AnalyzerConfig = AnalyzerConfig(), images: int = 200,
+                   seed: int = 0) -> dict:
+    """Compare the int8 models against fp32 on the same photos and write quantization_report.json.
+
+    Reports detection agreement, cosine similarity between the fp32 and
+    int8 embeddings of matched faces, how often both embeddings land in the
+    same cluster (nearest cluster centroid), the same figures for storing
+    fp32 embeddings as float16 and int8, and the time per image.
+    """
+    ctx = models.Context(data_root)
+    fp32 = detect_faces.create_analyzer(replace(config, quantized=False))
+    int8 = detect_faces.create_analyzer(replace(config, quantized=True))
+    sample = _sample_images(ctx, images, seed)
+    ref_embs, test_embs = [], []
+    counts = {'fp32_faces': 0, 'int8_faces': 0, 'matched_faces': 0}
+    seconds = {'fp32': 0.0, 'int8': 0.0}
+    for image_id in tqdm.tqdm(sample, desc="Comparing models"):
+        image = _load(ctx, image_id, config)
+        start = time.perf_counter()
+        ref = detect_faces.detect(fp32, image)
+        seconds['fp32'] += time.perf_counter() - start
+        start = time.perf_counter()
+        test = detect_faces.detect(int8, image)
+        seconds['int8'] += time.perf_counter() - start
+        matches = _match_faces(ref, test)
+        counts['fp32_faces'] += len(ref)
+        counts['int8_faces'] += len(test)
+        counts['matched_faces'] += len(matches)
+        for i, j in matches:
+            if ref[i].embedding is not None and test[j].embedding is not None:
+                ref_embs.append(ref[i].embedding)
+                test_embs.append(test[j].embedding)
+    if not ref_embs:
+        print(f"No faces found in both model versions on {len(sample)} images")
+        return {}
+    ref_embs = _normalize(np.array(ref_embs))
+    test_embs = _normalize(np.array(test_embs))
+
+    # embeddings as the store would keep them
+    variants = {'int8_model': test_embs}
+    for dtype in ('float16', 'int8'):
+        variants[f'{dtype}_storage'] = _normalize(decode(encode(ref_embs, dtype), dtype))
+
+    components = ctx.load_components()
+    centroids = None
+    if components:
+        matrix, face_ids = ctx.get_embeddings()
+        face_rows = {face_id: i for i, face_id in enumerate(face_ids)}
+        centroids = similarity.centroids(matrix, [np.array([face_rows[f] for f in c if f in face_rows], dtype=np.int64)
+                                                  for c in components])
+        ref_clusters = np.argmax(ref_embs @ centroids.T, axis=1)
+
+    report = {
+        'images': len(sample),
+        **counts,
+        'seconds_per_image': {name: s / max(len(sample), 1) for name, s in seconds.items()},
+    }
+    for name, embs in variants.items():
+        report[name] = {'cosine_to_fp32': _summary(np.sum(ref_embs * embs, axis=1))}
+        if centroids is not None:
+            same = np.argmax(embs @ centroids.T, axis=1) == ref_clusters
+            report[name]['same_cluster'] = float(same.mean())
+
+    models.write_json(data_root / REPORT_FILE, report)
+    print(f"{len(sample)} images: {counts['fp32_faces']} faces with fp32 models, {counts['int8_faces']} with int8, "
+          f"{counts['matched_faces']} matched")
+    print(f"Seconds per image: fp32 {report['seconds_per_image']['fp32']:.3f}, "
+          f"int8 {report['seconds_per_image']['int8']:.3f}")
+    for name in variants:
+        cos = report[name]['cosine_to_fp32']
+        line = f"{name}: cosine to fp32 mean {cos['mean']:.4f}, min {cos['min']:.4f}"
+        if 'same_cluster' in report[name]:
+            line += f", same cluster {report[name]['same_cluster']:.1%}"
+        print(line)
+    print(f"Report written to {data_root / REPORT_FILE}")
+    return report
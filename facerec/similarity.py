@@ -0,0 +1,88 @@
+from typing import Iterator
+import numpy as np
+
+
+def knn_blocks(
+    matrix: np.ndarray,
+    rows: np.ndarray | None = None,
+    threshold: float = 0.4,
+    k: int | None = None,
+    block_size: int = 256,
+) -> Iterator[tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """Yield (rows, cols, similarities) of neighbour pairs, one tile of query rows at a time.
+
+    `matrix` holds L2-normalized embeddings, `rows` selects the query rows
+    (all of them by default). A pair is kept when its cosine similarity is at
+    least `threshold`; if `k` is given, only the `k` most similar columns of
+    each row are considered. Self-pairs are dropped. Peak memory is about
+    `block_size * len(matrix)` similarities.
+    """
+    if rows is None:
+        rows = np.arange(matrix.shape[0])
+    rows = np.asarray(rows)
+    for start in range(0, len(rows), block_size):
+        block = rows[start:start + block_size]
+        sims = matrix[block] @ matrix.T
+        sims[np.arange(len(block)), block] = -np.inf
+        r, cols, vals = select_neighbours(sims, threshold, k)
+        yield block[r], cols, vals
+
+
+def select_neighbours(sims: np.ndarray, threshold: float, k: int | None = None) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Pick (row, col, similarity) entries of a similarity tile that pass `threshold`, at most `k` per row."""
+    n = sims.shape[1]
+    if k is not None and k <= 0:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty.copy(), np.empty(0, dtype=sims.dtype)
+    if k is not None and k < n:
+        cols = np.argpartition(sims, n - k, axis=1)[:, n - k:]
+        vals = np.take_along_axis(sims, cols, axis=1)
+        mask = vals >= threshold
+        rows = np.broadcast_to(np.arange(sims.shape[0])[:, None], cols.shape)[mask]
+        return rows, cols[mask], vals[mask]
+    rows, cols = np.nonzero(sims >= threshold)
+    return rows, cols, sims[rows, cols]
+
+
+def top_k(matrix: np.ndarray, vec: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+    """Return indices and similarities of the `k` rows of `matrix` closest to `vec`, best first."""
+    sims = matrix @ vec
+    k = min(k, len(sims))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64), sims[:0]
+    idx = np.argpartition(sims, len(sims) - k)[len(sims) - k:]
+    idx = idx[np.argsort(sims[idx])[::-1]]
+    return idx, sims[idx]
+
+
+def top_pairs(a: np.ndarray, b: np.ndarray, n: int,
+              block_size: int = 1024) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Return rows of `a`, rows of `b` and similarities of the `n` most similar pairs, best first.
+
+    Rows of `a` are compared against `b` in blocks, so at most
+    `block_size * len(b)` similarities are held at once.
+    """
+    rows, cols, vals = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.float32)]
+    for start in range(0, len(a), block_size):
+        sims = (a[start:start + block_size] @ b.T).ravel()
+        m = min(n, len(sims))
+        if m == 0:
+            continue
+        top = np.argpartition(sims, len(sims) - m)[len(sims) - m:]
+        r, c = np.divmod(top, len(b))
+        rows.append(r + start)
+        cols.append(c)
+        vals.append(sims[top])
+    rows, cols, vals = np.concatenate(rows), np.concatenate(cols), np.concatenate(vals)
+    order = np.argsort(-vals, kind='stable')[:n]
+    return rows[order], cols[order], vals[order]
+
+
+def centroids(matrix: np.ndarray, groups: list[np.ndarray]) -> np.ndarray:
+    """L2-normalized mean embedding of each group of rows of `matrix`."""
+    result = np.zeros((len(groups), matrix.shape[1]), dtype=np.float32)
+    for i, rows in enumerate(groups):
+        if len(rows):
+            result[i] = matrix[np.sort(rows)].mean(axis=0)
+    norms = np.linalg.norm(result, axis=1, keepdims=True)
+    return result / np.where(norms > 0, norms, 1)
@@ -0,0 +1,302 @@
+from pathlib import Path
+from collections.abc import Mapping
+from typing import Iterator
+import sqlite3
+import threading
+import weakref
+import numpy as np
+from pydantic import BaseModel
+
+from facerec import embeddings, models
+
+DB_FILE = 'facerec.db'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY,
+    key TEXT,
+    capture_date TEXT,
+    faces_detected_at TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS images_key ON images (key);
+CREATE INDEX IF NOT EXISTS images_capture_date ON images (capture_date);
+CREATE TABLE IF NOT EXISTS faces (
+    id INTEGER PRIMARY KEY,
+    image_id INTEGER,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS faces_image_id ON faces (image_id);
+CREATE TABLE IF NOT EXISTS embeddings (face_id INTEGER PRIMARY KEY, emb BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS face_components (face_id INTEGER PRIMARY KEY, component INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS face_components_component ON face_components (component);
+CREATE TABLE IF NOT EXISTS people (id INTEGER PRIMARY KEY, name TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS component_people (component INTEGER PRIMARY KEY, person_id INTEGER NOT NULL);
+'''
+
+
+class Database:
+    """SQLite-backed storage for one data directory.
+
+    The database runs in WAL mode, so `serve` can keep reading while
+    `discover` or `detect` write from another process.
+    """
+
+    def __init__(self, data_root: Path):
+        self.data_root = data_root
+        self.conn = sqlite3.connect(data_root / DB_FILE, check_same_thread=False, timeout=30)
+        self.lock = threading.RLock()
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(SCHEMA)
+        self.images = SqliteImages(self)
+        self.faces = SqliteFaces(self)
+        self.embeddings = SqliteEmbeddings(self)
+
+    def query(self, sql: str, args: tuple = ()) -> list[tuple]:
+        with self.lock:
+            return self.conn.execute(sql, args).fetchall()
+
+    def get_meta(self, key: str) -> str | None:
+        rows = self.query('SELECT value FROM meta WHERE key = ?', (key,))
+        return rows[0][0] if rows else None
+
+    def set_meta(self, key: str, value: str) -> None:
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+    def load_components(self) -> list[list[int]]:
+        rows = self.query('SELECT component, face_id FROM face_components ORDER BY component, face_id')
+        # components can be empty, the count keeps trailing ones (databases from before it: the largest id)
+        count = self.get_meta('component_count')
+        count = int(count) if count is not None else (rows[-1][0] + 1 if rows else 0)
+        components = [[] for _ in range(count)]
+        for component, face_id in rows:
+            components[component].append(face_id)
+        return components
+
+    def save_components(self, components: list[list[int]]) -> None:
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM face_components')
+            self.conn.executemany(
+                'INSERT INTO face_components (face_id, component) VALUES (?, ?)',
+                ((int(face_id), i) for i, component in enumerate(components) for face_id in component))
+            self.conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                              ('component_count', str(len(components))))
+
+    def load_people(self) -> dict[int, str]:
+        return dict(self.query('SELECT id, name FROM people'))
+
+    def save_people(self, people: dict[int, str]) -> None:
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM people')
+            self.conn.executemany('INSERT INTO people (id, name) VALUES (?, ?)', people.items())
+
+    def load_component_people(self) -> dict[int, int]:
+        return dict(self.query('SELECT component, person_id FROM component_people'))
+
+    def save_component_people(self, component_people: dict[int, int]) -> None:
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM component_people')
+            self.conn.executemany('INSERT INTO component_people (component, person_id) VALUES (?, ?)',
+                                  component_people.items())
+
+
+class SqliteRecords(Mapping):
+    """Read-through dict view of a table; records are only parsed when accessed."""
+
+    def __init__(self, db: Database, table: str, model: type[BaseModel]):
+        self.db = db
+        self.table = table
+        self.model = model
+        # objects handed out stay identical while referenced, so in-place edits are not lost
+        self.loaded = weakref.WeakValueDictionary()
+
+    def _parse(self, id: int, data: str) -> BaseModel:
+        record = self.loaded.get(id)
+        if record is None:
+            record = self.model.model_validate_json(data)
+            self.loaded[id] = record
+        return record
+
+    def __getitem__(self, id: int) -> BaseModel:
+        record = self.loaded.get(id)
+        if record is not None:
+            return record
+        rows = self.db.query(f'SELECT data FROM {self.table} WHERE id = ?', (id,))
+        if not rows:
+            raise KeyError(id)
+        return self._parse(id, rows[0][0])
+
+    def __contains__(self, id: object) -> bool:
+        return id in self.loaded or bool(self.db.query(f'SELECT 1 FROM {self.table} WHERE id = ?', (id,)))
+
+    def __iter__(self) -> Iterator[int]:
+        return iter([row[0] for row in self.db.query(f'SELECT id FROM {self.table} ORDER BY id')])
+
+    def __len__(self) -> int:
+        return self.db.query(f'SELECT COUNT(*) FROM {self.table}')[0][0]
+
+    def values(self) -> list[BaseModel]:
+        rows = self.db.query(f'SELECT id, data FROM {self.table} ORDER BY id')
+        return [self._parse(id, data) for id, data in rows]
+
+
+class SqliteStore:
+    """Counterpart of models.JsonlStore: added and dirty records are upserted on `write()`."""
+    table: str
+    model: type[BaseModel]
+    columns: tuple[str, ...] = ()
+
+    def __init__(self, db: Database):
+        self.db = db
+        self.records = SqliteRecords(db, self.table, self.model)
+        self.dirty: dict[int, BaseModel] = {}
+        max_id = db.query(f'SELECT MAX(id) FROM {self.table}')[0][0]
+        self.next_id = max_id + 1 if max_id is not None else 1
+
+    def dump(self, record: BaseModel) -> str:
+        return record.model_dump_json()
+
+    def row(self, record: BaseModel) -> tuple:
+        return (record.id, *(getattr(record, c) for c in self.columns), self.dump(record))
+
+    def add(self, record: BaseModel) -> None:
+        if record.id == 0:
+            record.id = self.next_id
+            self.next_id += 1
+        self.records.loaded[record.id] = record
+        self.dirty[record.id] = record
+
+    def mark_dirty(self, id: int) -> None:
+        self.dirty[id] = self.records[id]
+
+    def write(self) -> None:
+        if not self.dirty:
+            return
+        columns = ('id', *self.columns, 'data')
+        sql = (f'INSERT OR REPLACE INTO {self.table} ({", ".join(columns)}) '
+               f'VALUES ({", ".join("?" * len(columns))})')
+        with self.db.lock, self.db.conn:
+            self.db.conn.executemany(sql, [self.row(r) for r in self.dirty.values()])
+        self.dirty.clear()
+
+    def compact(self) -> None:
+        self.write()
+
+
+class SqliteImages(SqliteStore):
+    table = 'images'
+    model = models.Image
+    columns = ('key', 'capture_date', 'faces_detected_at')
+
+    def __init__(self, db: Database):
+        super().__init__(db)
+        self.images = self.records
+
+    def row(self, image: models.Image) -> tuple:
+        capture_date = image.capture_date.isoformat() if image.capture_date else None
+        detected_at = image.faces_detected_at.isoformat() if image.faces_detected_at else None
+        return (image.id, image.key, capture_date, detected_at, self.dump(image))
+
+    def duplicate_links(self) -> dict[int, int]:
+        """Image id -> id of its representative, for images linked by `dedup`, without parsing records."""
+        links = dict(self.db.query("SELECT id, json_extract(data, '$.duplicate_of') FROM images "
+                                   "WHERE json_extract(data, '$.duplicate_of') IS NOT NULL"))
+        # records changed since the last write
+        for image in self.dirty.values():
+            links.pop(image.id, None)
+            if image.duplicate_of is not None:
+                links[image.id] = image.duplicate_of
+        return links
+
+
+class SqliteFaces(SqliteStore):
+    table = 'faces'
+    model = models.Face
+    columns = ('image_id',)
+
+    def __init__(self, db: Database):
+        super().__init__(db)
+        self.faces = self.records
+
+    def dump(self, face: models.Face) -> str:
+        exclude = {'emb'} if face.emb is None else None
+        return face.model_dump_json(exclude=exclude)
+
+    def by_image(self, image_id: int) -> list[int]:
+        return [row[0] for row in self.db.query('SELECT id FROM faces WHERE image_id = ? ORDER BY id', (image_id,))]
+
+
+class SqliteEmbeddings:
+    """Counterpart of embeddings.EmbeddingStore keeping one BLOB per face."""
+
+    def __init__(self, db: Database, dtype: str = 'float32', dim: int = 512):
+        self.db = db
+        self.dtype = db.get_meta('embedding_dtype') or dtype
+        self.dim = int(db.get_meta('embedding_dim') or dim)
+        self.pending: dict[int, np.ndarray] = {}
+        self._rows = None
+        self._matrix = None
+
+    def __len__(self) -> int:
+        return self.db.query('SELECT COUNT(*) FROM embeddings')[0][0] + len(self.pending)
+
+    def _load(self) -> None:
+        rows = self.db.query('SELECT face_id, emb FROM embeddings ORDER BY face_id')
+        self._rows = {face_id: i for i, (face_id, _) in enumerate(rows)}
+        data = np.frombuffer(b''.join(emb for _, emb in rows), dtype=embeddings.row_dtype(self.dtype, self.dim))
+        self._matrix = embeddings.decode(data, self.dtype).reshape(-1, self.dim)
+
+    @property
+    def rows(self) -> dict[int, int]:
+        if self._rows is None:
+            self._load()
+        return self._rows
+
+    def matrix(self) -> np.ndarray:
+        if self._matrix is None:
+            self._load()
+        return self._matrix
+
+    def add(self, face_id: int, emb: np.ndarray) -> None:
+        emb = np.asarray(emb, dtype=np.float64)
+        self.pending[face_id] = embeddings.encode(emb / np.linalg.norm(emb), self.dtype)
+
+    def flush(self) -> None:
+        if not self.pending:
+            return
+        with self.db.lock, self.db.conn:
+            self.db.conn.execute('INSERT OR IGNORE INTO meta (key, value) VALUES (?, ?)', ('embedding_dtype', self.dtype))
+            self.db.conn.execute('INSERT OR IGNORE INTO meta (key, value) VALUES (?, ?)', ('embedding_dim', str(self.dim)))
+            self.db.conn.executemany('INSERT OR REPLACE INTO embeddings (face_id, emb) VALUES (?, ?)',
+                                     ((face_id, emb.tobytes()) for face_id, emb in self.pending.items()))
+        self.pending = {}
+        self._rows = None
+        self._matrix = None
+
+
+def convert_to_sqlite(data_root: Path) -> None:
+    """Copy a JSONL data directory into facerec.db; Context picks the database up from then on."""
+    if (data_root / DB_FILE).exists():
+        print(f"{data_root / DB_FILE} already exists")
+        return
+    ctx = models.Context(data_root)
+    matrix, face_ids = ctx.get_embeddings()
+    db = Database(data_root)
+    db.embeddings.dtype = ctx.embeddings.dtype
+    for image in ctx.images.images.values():
+        db.images.add(image)
+    db.images.write()
+    for face in ctx.faces.faces.values():
+        face.emb = None
+        db.faces.add(face)
+    db.faces.write()
+    for face_id, emb in zip(face_ids, matrix):
+        db.embeddings.pending[face_id] = embeddings.encode(emb, db.embeddings.dtype)
+    db.embeddings.flush()
+    db.save_components(ctx.load_components())
+    db.save_people(ctx.load_people())
+    db.save_component_people(ctx.load_component_people())
+    print(f"Copied {len(ctx.images.images)} images and {len(face_ids)} faces into {data_root / DB_FILE}")
@@ -0,0 +1,45 @@
+import numpy as np
+
+from facerec import similarity, community, ann_index
+from facerec.graph_store import CSRGraph
+
+METHODS = ('louvain', 'kmeans')
+
+
+def local_graph(matrix: np.ndarray, rows: np.ndarray, face_ids: np.ndarray,
+                threshold: float = 0.4, k: int | None = 20) -> CSRGraph:
+    """Similarity graph among the faces of one component, computed from their embeddings."""
+    vecs = np.ascontiguousarray(matrix[rows], dtype=np.float32)
+    ids1, ids2, weights = [], [], []
+    for r, c, sims in similarity.knn_blocks(vecs, threshold=threshold, k=k):
+        ids1.append(face_ids[r])
+        ids2.append(face_ids[c])
+        weights.append(sims)
+    if not ids1:
+        return CSRGraph.from_edges([], [], np.empty(0, dtype=np.float32), nodes=face_ids)
+    return CSRGraph.from_edges(np.concatenate(ids1), np.concatenate(ids2), np.concatenate(weights), nodes=face_ids)
+
+
+def propose_subdivision(matrix: np.ndarray, rows: np.ndarray, face_ids: list[int], method: str = 'louvain',
+                        n_clusters: int | None = None, threshold: float = 0.4, resolution: float = 1.0,
+                        seed: int = 0) -> list[list[int]]:
+    """Split one component into sub-communities, largest first.
+
+    Args:
+        rows: rows of `matrix` holding the embeddings of `face_ids`.
+        method: 'louvain' on the local k-nearest-neighbour graph, or
+            'kmeans' (spherical k-means into `n_clusters` groups, 2 by default).
+    """
+    face_ids = np.asarray(face_ids, dtype=np.int64)
+    if len(face_ids) < 2:
+        return community.sort_communities([face_ids])
+    if method == 'louvain':
+        graph = local_graph(matrix, rows, face_ids, threshold=threshold)
+        # graph nodes are sorted, so map the labels back by node
+        return community.sort_communities(
+            community.group_labels(graph.nodes, community.louvain(graph, resolution=resolution, seed=seed)))
+    if method == 'kmeans':
+        vecs = np.ascontiguousarray(matrix[rows], dtype=np.float32)
+        centroids = ann_index.kmeans(vecs, min(n_clusters or 2, len(vecs)), seed=seed)
+        return community.sort_communities(community.group_labels(face_ids, ann_index.assign_to_centroids(vecs, centroids)))
+    raise ValueError(f"Unknown subdivision method {method!r}, expected one of {METHODS}")